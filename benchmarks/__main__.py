@@ -0,0 +1,113 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from .compare import compare, format_rows
+from .stores import STORES
+from .workloads import ORDERS, get_cases, run_cases
+
+
+def _get_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+
+def run(args):
+    cases = get_cases(
+        args.stores, [int(float(n)) for n in args.n_keys],
+        args.value_types, args.value_sizes, args.orders, args.batches,
+        int(float(args.n_lookups)), args.workdir or tempfile.mkdtemp())
+
+    def show(results):
+        for r in results:
+            if "error" in r:
+                print(f"{r['store']}: skipped, {r['error']}", file=sys.stderr)
+                continue
+            print(f"{r['store']:<12} {r['workload']:<14} n={r['n_keys']:<10}"
+                  f" {r['value_type']}:{r['value_size']:<6}"
+                  f" batch={r['batch']:<6} {r['ops_per_s']:>12.0f} ops/s"
+                  f" p50={r['p50_us']:.1f}us p99={r['p99_us']:.1f}us"
+                  f" size={r['file_size']}", file=sys.stderr)
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "revision": _get_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "argv": sys.argv[1:],
+        },
+        "results": run_cases(cases, callback=show),
+    }
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+def run_compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    rows, regressions = compare(baseline, current, args.threshold)
+    print(format_rows(regressions if args.regressions_only else rows))
+    if regressions:
+        print(f"{len(regressions)} regressions beyond {args.threshold:.0%}",
+              file=sys.stderr)
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Benchmarks of loom against other key-value stores")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parser_run = commands.add_parser("run", help="run workloads")
+    parser_run.add_argument(
+        "--stores", nargs="+", default=["loom", "loom-list", "sqlite",
+                                        "shelve"],
+        help=f"among {', '.join(STORES)}, with options as 'loom:io=mmap'")
+    parser_run.add_argument("--n-keys", nargs="+", default=["1e4", "1e5"])
+    parser_run.add_argument("--value-types", nargs="+",
+                            choices=("blob", "fixed"),
+                            default=["blob", "fixed"])
+    parser_run.add_argument("--value-sizes", nargs="+", type=int,
+                            default=[16, 400])
+    parser_run.add_argument("--orders", nargs="+", choices=ORDERS,
+                            default=list(ORDERS))
+    parser_run.add_argument("--batches", nargs="+", type=int, default=[1],
+                            help="keys per call, 1 for single key calls")
+    parser_run.add_argument("--n-lookups", default="1e5")
+    parser_run.add_argument("--workdir",
+                            help="directory of the store files")
+    parser_run.add_argument("--output", "-o",
+                            help="JSON report, printed when not given")
+    parser_run.set_defaults(fn=run)
+
+    parser_compare = commands.add_parser(
+        "compare", help="compare two reports, exit with 1 on regressions")
+    parser_compare.add_argument("baseline")
+    parser_compare.add_argument("current")
+    parser_compare.add_argument("--threshold", type=float, default=.1)
+    parser_compare.add_argument("--regressions-only", action="store_true")
+    parser_compare.set_defaults(fn=run_compare)
+
+    args = parser.parse_args()
+    args.fn(args)
+
+
+if __name__ == "__main__":
+    main()
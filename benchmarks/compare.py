@@ -0,0 +1,53 @@
+CASE_FIELDS = ("store", "n_keys", "value_type", "value_size", "order",
+               "batch", "n_lookups", "workload")
+
+# metric, and whether higher values are better
+METRICS = (("ops_per_s", True), ("p50_us", False), ("p99_us", False),
+           ("file_size", False), ("peak_rss_bytes", False))
+
+
+def _get_case(result):
+    return tuple(result.get(field) for field in CASE_FIELDS)
+
+
+def compare(baseline, current, threshold=.1):
+    """
+    (dict) baseline, current: reports written by a run
+    (float) threshold: relative change of a metric counted as a regression
+
+    Returns one row per case and metric found in both reports, with the
+    ratio of the current value to the baseline one, and the rows that
+    regressed.
+    """
+    baseline = {_get_case(r): r for r in baseline["results"]
+                if "error" not in r}
+    rows = []
+    regressions = []
+    for result in current["results"]:
+        case = _get_case(result)
+        if "error" in result or case not in baseline:
+            continue
+        for metric, higher_is_better in METRICS:
+            old, new = baseline[case].get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            ratio = new / old
+            row = {**dict(zip(CASE_FIELDS, case)), "metric": metric,
+                   "baseline": old, "current": new, "ratio": ratio}
+            rows.append(row)
+            if (higher_is_better and ratio < 1 - threshold) or \
+                    (not higher_is_better and ratio > 1 + threshold):
+                regressions.append(row)
+    return rows, regressions
+
+
+def format_rows(rows):
+    lines = []
+    for row in rows:
+        lines.append(
+            f"{row['store']:<12} {row['workload']:<14} n={row['n_keys']:<10}"
+            f" {row['value_type']}:{row['value_size']:<6}"
+            f" batch={row['batch']:<6} {row['metric']:<15}"
+            f" {row['baseline']:>14.6g} -> {row['current']:>14.6g}"
+            f" ({row['ratio'] - 1:+.1%})")
+    return "\n".join(lines)
@@ -0,0 +1,82 @@
+import os
+import resource
+import time
+
+import numpy as np
+
+# latencies kept per phase, the others are skipped evenly
+MAX_SAMPLES = 10**6
+
+
+def get_io_counters():
+    # read and write syscalls and bytes of the process, Linux only
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+    except OSError:
+        return None
+    return {"read_calls": int(counters["syscr"]),
+            "write_calls": int(counters["syscw"]),
+            "read_bytes": int(counters["rchar"]),
+            "write_bytes": int(counters["wchar"])}
+
+
+def get_rss():
+    # current resident set size, and the peak one, in bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE"), peak
+    except OSError:
+        return peak, peak
+
+
+class Timer:
+    def __init__(self, n_calls, ops_per_call=1):
+        """
+        (int) n_calls: number of calls about to be timed
+        (int) ops_per_call: operations done by each call, latencies are
+                            given per call
+        """
+        self.ops_per_call = ops_per_call
+        self.stride = max(n_calls // MAX_SAMPLES, 1)
+        self.samples = []
+        self.n_calls = 0
+        self.total = 0
+
+    def __enter__(self):
+        self._io = get_io_counters()
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *_):
+        self.total = time.perf_counter_ns() - self._start
+        io = get_io_counters()
+        if io is None or self._io is None:
+            self.io = None
+        else:
+            self.io = {key: io[key] - self._io[key] for key in io}
+
+    def time(self, fn, *args):
+        start = time.perf_counter_ns()
+        res = fn(*args)
+        if self.n_calls % self.stride == 0:
+            self.samples.append(time.perf_counter_ns() - start)
+        self.n_calls += 1
+        return res
+
+    def report(self):
+        samples = np.array(self.samples or [0], dtype=np.float64)
+        n_ops = self.n_calls * self.ops_per_call
+        rss, peak_rss = get_rss()
+        return {
+            "ops": n_ops,
+            "seconds": self.total / 1e9,
+            "ops_per_s": n_ops / (self.total / 1e9) if self.total else 0.,
+            "p50_us": float(np.percentile(samples, 50)) / 1e3,
+            "p99_us": float(np.percentile(samples, 99)) / 1e3,
+            "io": self.io,
+            "rss_bytes": rss,
+            "peak_rss_bytes": peak_rss,
+        }
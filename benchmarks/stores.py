@@ -0,0 +1,279 @@
+import glob
+import os
+import pickle
+import shelve
+import sqlite3
+import struct
+
+import numpy as np
+
+
+class Store:
+    # key-value store under test, values are either bytes or float32 vectors
+    name = None
+    # keys are any strings, or positions given in order
+    keyed = True
+
+    def __init__(self, path, value_type, value_size, **options):
+        """
+        (str) path: path prefix of the files of the store
+        (str) value_type: 'blob' for bytes values, 'fixed' for float32
+                          vectors stored in a fixed size column
+        (int) value_size: size in bytes of the values
+        (kwargs) options: store specific options
+        """
+        self.path = path
+        self.value_type = value_type
+        self.value_size = value_size
+        self.options = options
+
+    def make_key(self, i):
+        return f"key_{i}"
+
+    def set_many(self, keys, values):
+        for key, value in zip(keys, values):
+            self.set(key, value)
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+    def close(self):
+        pass
+
+    def file_size(self):
+        return sum(os.path.getsize(filename)
+                   for filename in glob.glob(f"{self.path}*")
+                   if os.path.isfile(filename))
+
+
+class LoomDict(Store):
+    # no LRU cache, so that lookups read the file as other stores do
+    name = "loom"
+    lru_cache = 0
+
+    def __init__(self, path, value_type, value_size, **options):
+        import loom
+
+        options.setdefault("lru_cache", self.lru_cache)
+        super().__init__(path, value_type, value_size, **options)
+        if value_type == "fixed":
+            options["dtype"] = f"({value_size // 4},)float32"
+        self.db = loom.Dict(f"{path}.loom", flag="n", **options)
+
+    def set(self, key, value):
+        self.db[key] = value
+
+    def get(self, key):
+        try:
+            return self.db[key]
+        except KeyError:
+            return None
+
+    def set_many(self, keys, values):
+        self.db.set_many(keys, values)
+
+    def get_many(self, keys):
+        return self.db.get_many(keys)
+
+    def close(self):
+        self.db.db.close()
+
+
+class LoomCachedDict(LoomDict):
+    # the default LRU cache of loom.Dict, lookups of recent keys being
+    # served from memory
+    name = "loom-cached"
+    lru_cache = 10000
+
+
+class LoomList(Store):
+    # rows of a List on a plain DB, keys being their positions
+    name = "loom-list"
+    keyed = False
+
+    def __init__(self, path, value_type, value_size, **options):
+        import loom
+        from loom.datastructure import List
+
+        super().__init__(path, value_type, value_size, **options)
+        if value_type == "fixed":
+            dt = f"({value_size // 4},)float32"
+        else:
+            dt = "blob"
+        self.db = loom.DB(f"{path}.loom", flag="n", **options)
+        self.db.create_datastructure(
+            "list", List(self.db.create_dataset("rows", value=dt)))
+        self.db.compile()
+        self.list = self.db["list"]
+
+    def make_key(self, i):
+        return i
+
+    def set(self, key, value):
+        self.list.append({"value": value})
+
+    def get(self, key):
+        return self.list[key]["value"]
+
+    def set_many(self, keys, values):
+        self.list.extend([{"value": value} for value in values])
+
+    def get_many(self, keys):
+        rows = self.list.lookup_many(keys, columnar=True)
+        return list(rows["value"])
+
+    def close(self):
+        self.db.close()
+
+
+class SqliteStore(Store):
+    # one connection, a commit per call as loom does, and no fsync unless
+    # asked since loom only hands writes to the OS by default
+    name = "sqlite"
+
+    def __init__(self, path, value_type, value_size, synchronous="OFF",
+                 **options):
+        super().__init__(path, value_type, value_size, **options)
+        self.conn = sqlite3.connect(f"{path}.sqlite")
+        self.conn.execute(f"PRAGMA synchronous={synchronous}")
+        self.conn.execute(
+            "CREATE TABLE kv (key TEXT PRIMARY KEY, value BLOB)")
+        self.conn.commit()
+
+    def _dumps(self, value):
+        if self.value_type == "fixed":
+            return value.tobytes()
+        return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _loads(self, data):
+        if self.value_type == "fixed":
+            return np.frombuffer(data, dtype=np.float32)
+        return pickle.loads(data)
+
+    def set(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO kv VALUES (?, ?)",
+                          (key, self._dumps(value)))
+        self.conn.commit()
+
+    def get(self, key):
+        row = self.conn.execute(
+            "SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        return None if row is None else self._loads(row[0])
+
+    def set_many(self, keys, values):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO kv VALUES (?, ?)",
+            [(key, self._dumps(value)) for key, value in zip(keys, values)])
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+class ShelveStore(Store):
+    name = "shelve"
+
+    def __init__(self, path, value_type, value_size, **options):
+        super().__init__(path, value_type, value_size, **options)
+        self.shelf = shelve.open(f"{path}.shelve", flag="n",
+                                 protocol=pickle.HIGHEST_PROTOCOL)
+
+    def set(self, key, value):
+        self.shelf[key] = value
+
+    def get(self, key):
+        return self.shelf.get(key)
+
+    def close(self):
+        self.shelf.close()
+
+
+class LmdbStore(Store):
+    # requires the lmdb package, a write transaction per call
+    name = "lmdb"
+
+    def __init__(self, path, value_type, value_size, map_size=2**40,
+                 **options):
+        import lmdb
+
+        super().__init__(path, value_type, value_size, **options)
+        self.env = lmdb.open(f"{path}.lmdb", map_size=int(map_size),
+                             sync=False, subdir=False, lock=False)
+
+    def _dumps(self, value):
+        if self.value_type == "fixed":
+            return value.tobytes()
+        return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _loads(self, data):
+        if self.value_type == "fixed":
+            return np.frombuffer(data, dtype=np.float32)
+        return pickle.loads(data)
+
+    def set(self, key, value):
+        with self.env.begin(write=True) as txn:
+            txn.put(key.encode(), self._dumps(value))
+
+    def get(self, key):
+        with self.env.begin() as txn:
+            data = txn.get(key.encode())
+        return None if data is None else self._loads(data)
+
+    def set_many(self, keys, values):
+        with self.env.begin(write=True) as txn:
+            for key, value in zip(keys, values):
+                txn.put(key.encode(), self._dumps(value))
+
+    def get_many(self, keys):
+        with self.env.begin() as txn:
+            res = [txn.get(key.encode()) for key in keys]
+        return [None if data is None else self._loads(data) for data in res]
+
+    def close(self):
+        self.env.close()
+
+
+STORES = {store.name: store for store in (
+    LoomDict, LoomCachedDict, LoomList, SqliteStore, ShelveStore,
+    LmdbStore)}
+
+
+def parse_store(spec):
+    """
+    (str) spec: name of a store, optionally followed by its options as in
+                'loom:io=mmap,wal=1', values being parsed as numbers or
+                booleans when possible
+
+    Returns the store class and its options.
+    """
+    name, _, options = spec.partition(":")
+    if name not in STORES:
+        raise ValueError(f"Store {name} unknown, choose among {list(STORES)}")
+    kwargs = {}
+    for option in filter(None, options.split(",")):
+        key, _, value = option.partition("=")
+        kwargs[key] = _parse_value(value)
+    return STORES[name], kwargs
+
+
+def _parse_value(value):
+    if value.lower() in ("true", "false"):
+        return value.lower() == "true"
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+
+def make_value(value_type, value_size, seed=0):
+    if value_type == "fixed":
+        if value_size % 4 != 0:
+            raise ValueError("Fixed values hold float32, size must be a "
+                             "multiple of 4")
+        rng = np.random.default_rng(seed)
+        return rng.random(value_size // 4, dtype=np.float32)
+    # bytes whose pickle is about value_size bytes long
+    header = len(pickle.dumps(b"", protocol=pickle.HIGHEST_PROTOCOL))
+    return struct.pack("<Q", seed) * (max(value_size - header, 8) // 8)
@@ -0,0 +1,126 @@
+import glob
+import math
+import multiprocessing
+import os
+
+import numpy as np
+
+from .metrics import Timer
+from .stores import make_value, parse_store
+
+ORDERS = ("seq", "random")
+
+
+def _permute(indices, n):
+    # bijection of range(n) spreading consecutive indices, so that random
+    # orders do not need a permutation of n keys in memory
+    a = int(n * 0.6180339887) | 1
+    while math.gcd(a, n) != 1:
+        a += 2
+    return (indices * a + n // 3) % n
+
+
+def _batches(n, batch):
+    for start in range(0, n, batch):
+        yield np.arange(start, min(start + batch, n), dtype=np.int64)
+
+
+def _run_phase(store, keys_batches, n_calls, batch, value=None):
+    timer = Timer(n_calls, batch)
+    with timer:
+        for indices in keys_batches:
+            keys = [store.make_key(i) for i in indices.tolist()]
+            if batch == 1 and value is None:
+                timer.time(store.get, keys[0])
+            elif batch == 1:
+                timer.time(store.set, keys[0], value)
+            elif value is None:
+                timer.time(store.get_many, keys)
+            else:
+                timer.time(store.set_many, keys, [value] * len(keys))
+    return timer.report()
+
+
+def run_case(case):
+    """
+    (dict) case: store spec, n_keys, value_type, value_size, order of the
+                 inserts, batch size of the calls, n_lookups and workdir
+
+    Fills a new store and looks keys up in it, returns one result per
+    phase: insert_seq or insert_random, then lookup_hit and lookup_miss.
+    """
+    store_cls, options = parse_store(case["store"])
+    fields = {key: value for key, value in case.items() if key != "workdir"}
+    if case["order"] == "random" and not store_cls.keyed:
+        return []
+
+    path = os.path.join(case["workdir"], "bench")
+    for filename in glob.glob(f"{path}*"):
+        os.remove(filename)
+    try:
+        store = store_cls(path, case["value_type"], case["value_size"],
+                          **options)
+    except ImportError as e:
+        return [{**fields, "workload": None, "error": str(e)}]
+
+    n, batch = case["n_keys"], case["batch"]
+    value = make_value(case["value_type"], case["value_size"])
+    n_calls = math.ceil(n / batch)
+    results = []
+
+    batches = _batches(n, batch)
+    if case["order"] == "random":
+        batches = (_permute(indices, n) for indices in batches)
+    results.append({**fields, "workload": f"insert_{case['order']}",
+                    **_run_phase(store, batches, n_calls, batch, value)})
+
+    # lookups of random keys, then of keys that were never inserted
+    n_lookups = min(case["n_lookups"], n)
+    n_calls = math.ceil(n_lookups / batch)
+    rng = np.random.default_rng(0)
+    batches = (rng.integers(0, n, len(indices))
+               for indices in _batches(n_lookups, batch))
+    results.append({**fields, "workload": "lookup_hit",
+                    **_run_phase(store, batches, n_calls, batch)})
+    if store_cls.keyed:
+        batches = (indices + n for indices in _batches(n_lookups, batch))
+        results.append({**fields, "workload": "lookup_miss",
+                        **_run_phase(store, batches, n_calls, batch)})
+
+    store.close()
+    file_size = store.file_size()
+    for filename in glob.glob(f"{path}*"):
+        os.remove(filename)
+    for result in results:
+        result["file_size"] = file_size
+    return results
+
+
+def get_cases(stores, n_keys, value_types, value_sizes, orders, batches,
+              n_lookups, workdir):
+    return [{"store": store, "n_keys": int(n), "value_type": value_type,
+             "value_size": int(value_size), "order": order,
+             "batch": int(batch), "n_lookups": int(n_lookups),
+             "workdir": workdir}
+            for store in stores for n in n_keys
+            for value_type in value_types for value_size in value_sizes
+            for order in orders for batch in batches]
+
+
+def run_cases(cases, callback=None):
+    """
+    (list) cases: cases as given by get_cases
+    (function) callback: called with the results of each case
+
+    Every case runs in a new process, so that memory and IO counters are
+    its own.
+    """
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for case in cases:
+        with context.Pool(1) as pool:
+            case_results = pool.apply(run_case, (case,))
+        if callback is not None:
+            callback(case_results)
+        results.extend(case_results)
+    return results
@@ -0,0 +1,49 @@
+import os
+
+import numpy as np
+
+import loom
+from loom.datastructure import List
+
+FILENAME = "compact.loom"
+N = 20000
+
+
+def create_database():
+    db = loom.DB(FILENAME, flag="n")
+    rows = db.create_dataset("rows", x="uint32", text="blob")
+    db.create_datastructure("list", List(rows))
+    db.compile()
+    db["list"].extend({"x": i, "text": f"row {i}"} for i in range(N))
+    # the blobs overwritten are left behind in the file
+    for i in range(0, N, 2):
+        db["list"][i] = {"x": i, "text": f"row {i} " * 10}
+    db.close()
+
+
+def check(db):
+    rows = db["list"].get_slice(0, N)
+    assert np.array_equal(rows["x"], np.arange(N))
+    for i in range(0, N, 1000):
+        expected = f"row {i} " * 10 if i % 2 == 0 else f"row {i}"
+        assert rows["text"][i] == expected, i
+
+
+if __name__ == "__main__":
+    create_database()
+
+    db = loom.DB(FILENAME)
+    check(db)
+    size = os.path.getsize(FILENAME)
+    print(db.compact(), "bytes reclaimed out of", size)
+    check(db)
+
+    # the compacted file keeps growing from where the copy stopped
+    db["list"].append({"x": N, "text": "appended"})
+    db.close()
+
+    db = loom.DB(FILENAME, flag="r")
+    check(db)
+    assert db["list"][-1]["text"] == "appended"
+    db.close()
+    print("ok")
@@ -0,0 +1,47 @@
+import os
+
+import loom
+
+FILENAME = "migrate.loom"
+N = 100000
+
+
+def check(db):
+    values = db.get_many([f"key_{i}" for i in range(N)])
+    assert values == list(range(N))
+
+
+if __name__ == "__main__":
+    # each resize adds a table, a few old buckets being moved to the
+    # newest table on every insert
+    db = loom.Dict(FILENAME, flag="n", dtype="int64", p_init=10,
+                   migrate_buckets=4, lru_cache=0)
+    for i in range(N):
+        db[f"key_{i}"] = i
+    print("levels after the inserts:", db.table._levels)
+    db.db.close()
+
+    # the levels left are kept in the file, but not the migration
+    # position: the oldest table is gone through again from its first slot
+    db = loom.Dict(FILENAME, lru_cache=0)
+    check(db)
+    db.table.migrate()
+    # the oldest table only keeps the few keys that fit in no newer one
+    levels = db.table._levels
+    print("levels after migrate():", levels)
+    left = db.table._get_load(levels[-1]) * db.table._get_capacity(levels[-1])
+    assert len(levels) == 1 or (len(levels) == 2 and left < N // 20)
+    check(db)
+    # keys that do not fit in their probe window of the compacted table
+    # go to a small one
+    print("file size before compaction:", os.path.getsize(FILENAME))
+    db.vacuum()
+    print("file size after compaction:", os.path.getsize(FILENAME))
+    print("levels after compaction:", db.table._levels)
+    check(db)
+    db.db.close()
+
+    db = loom.Dict(FILENAME, lru_cache=0)
+    check(db)
+    db.db.close()
+    print("ok")
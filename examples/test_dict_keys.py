@@ -0,0 +1,31 @@
+import loom
+
+FILENAME = "dict_keys.loom"
+
+
+def raises(error, fn, *args):
+    try:
+        fn(*args)
+    except error:
+        return True
+    return False
+
+
+if __name__ == "__main__":
+    # keys are checked the same way one by one and in bulk, instead of
+    # being truncated to the length of the key field
+    db = loom.Dict(FILENAME, flag="n", dtype="int64", use_hash=False,
+                   max_key_len=5, lru_cache=0)
+    assert raises(ValueError, db.__setitem__, "abcdefgh", 1)
+    assert raises(ValueError, db.set_many, ["abcdefgh", "xy"], [1, 2])
+    assert raises(ValueError, db.update, {"xy": 2, "ab\0": 3})
+    db.set_many(["abcde", "xy"], [1, 2])
+    assert raises(KeyError, db.__getitem__, "abcdefgh")
+    assert db.get_many(["abcdefgh", "abcde", "xy"]) == [None, 1, 2]
+
+    # a value is never repeated for several keys
+    assert raises(ValueError, db.set_many, ["p", "q"], [7])
+    assert raises(ValueError, db.set_many, ["p"], [7, 8])
+    assert db.get_many(["p", "q"]) == [None, None]
+    db.db.close()
+    print("ok")
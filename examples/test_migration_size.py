@@ -0,0 +1,29 @@
+import os
+
+import loom
+
+N = 100000
+
+
+def insert(filename, migrate_buckets):
+    db = loom.Dict(filename, flag="n", dtype="int64",
+                   migrate_buckets=migrate_buckets, lru_cache=0)
+    for i in range(N):
+        db[f"key_{i}"] = i
+    levels = list(db.table._levels)
+    assert db.get_many([f"key_{i}" for i in range(N)]) == list(range(N))
+    db.db.close()
+    return levels, os.path.getsize(filename)
+
+
+if __name__ == "__main__":
+    # keys whose probe window is full go back to the table being migrated,
+    # or to a dropped one reusing its space, so that moving keys does not
+    # make the tables larger than when they are left in place
+    levels, size = insert("migration_size.loom", 0)
+    migrated_levels, migrated_size = insert("migration_size_4.loom", 4)
+    print("levels:", levels, size, "bytes")
+    print("levels with migration:", migrated_levels, migrated_size, "bytes")
+    assert max(migrated_levels) <= max(levels), migrated_levels
+    assert migrated_size <= 1.25 * size, migrated_size
+    print("ok")
@@ -0,0 +1,56 @@
+import threading
+
+import loom
+
+FILENAME = "migration_threads.loom"
+N = 2000
+BATCH = 100
+N_READERS = 4
+
+
+def read(db, stop, errors):
+    # every key written before the readers started is always found, while
+    # its table is migrated and dropped
+    keys = [f"key_{i}" for i in range(N)]
+    while not stop.is_set():
+        try:
+            for i in range(0, N, 97):
+                assert db[keys[i]] == i, i
+            values = db.get_many(keys[::13])
+            assert values == list(range(0, N, 13)), "get_many"
+        except Exception as e:
+            errors.append(repr(e))
+            return
+
+
+if __name__ == "__main__":
+    db = loom.Dict(FILENAME, flag="n", dtype="int64", p_init=10,
+                   migrate_buckets=4, threadsafe=True, lru_cache=0)
+    db.update({f"key_{i}": i for i in range(N)})
+
+    stop = threading.Event()
+    errors = []
+    readers = [threading.Thread(target=read, args=(db, stop, errors))
+               for _ in range(N_READERS)]
+    for reader in readers:
+        reader.start()
+
+    # new keys add tables, whose predecessors are migrated and dropped
+    for start in range(N, 20 * N, BATCH):
+        db.update({f"key_{i}": i for i in range(start, start + BATCH)})
+        if len(errors):
+            break
+    db.table.migrate()
+    stop.set()
+    for reader in readers:
+        reader.join()
+
+    # the oldest table only keeps the few keys that fit in no newer one
+    assert errors == [], errors[:5]
+    levels = db.table._levels
+    left = db.table._get_load(levels[-1]) * db.table._get_capacity(levels[-1])
+    assert len(levels) == 1 or (len(levels) == 2 and left < N), levels
+    print("levels:", db.table._levels, "migrated:",
+          db.stats()["table"]["migrated_keys"])
+    db.db.close()
+    print("ok")
@@ -0,0 +1,35 @@
+import numpy as np
+
+import loom
+from loom.datastructure import List
+
+# values read through the mapping are detached from the file: changing
+# them does not write to it, and overwriting their rows does not change them
+db = loom.Dict("mmap_values.loom", flag="n", dtype="(4,)float32", io="mmap",
+               lru_cache=0)
+db["a"] = np.zeros(4)
+value = db["a"]
+if value.flags.writeable:
+    value += 1
+assert np.array_equal(db["a"], np.zeros(4))
+
+held = value.copy()
+db["a"] = np.full(4, 2)
+assert np.array_equal(value, held)
+values = db.get_many(["a"])
+db["a"] = np.full(4, 3)
+assert np.array_equal(values[0], np.full(4, 2))
+db.db.close()
+
+db = loom.DB("mmap_values.loom", flag="n", io="mmap")
+rows = db.create_dataset("rows", x="int64")
+db.create_datastructure("list", List(rows))
+db.compile()
+db["list"].extend({"x": i} for i in range(100))
+for rows in (db["list"].get_slice(0, 100), db["list"].lookup_many([1, 2])):
+    held = rows["x"].copy()
+    db["list"].insert_many([1, 2], [{"x": -1}, {"x": -1}])
+    assert np.array_equal(rows["x"], held)
+    db["list"].insert_many([1, 2], [{"x": 1}, {"x": 2}])
+db.close()
+print("ok")
@@ -0,0 +1,32 @@
+import multiprocessing
+import os
+import time
+
+import loom
+
+FILENAME = "wal_idle.loom"
+N = 100
+
+
+def write_and_idle():
+    db = loom.Dict(FILENAME, flag="n", wal=True, threadsafe=True,
+                   lru_cache=0)
+    db.update({f"key_{i}": i for i in range(N)})
+    groups = db.stats()["db"]["wal_groups"]
+
+    # no write follows, the group is committed once its window expires
+    time.sleep(.5)
+    assert db.stats()["db"]["wal_groups"] == groups + 1, db.stats()["db"]
+    os._exit(1)
+
+
+if __name__ == "__main__":
+    process = multiprocessing.Process(target=write_and_idle)
+    process.start()
+    process.join()
+    assert process.exitcode == 1
+
+    db = loom.Dict(FILENAME, wal=True, lru_cache=0)
+    assert db.get_many([f"key_{i}" for i in range(N)]) == list(range(N))
+    db.db.close()
+    print("ok")
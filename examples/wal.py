@@ -0,0 +1,49 @@
+import multiprocessing
+import os
+
+import loom
+
+FILENAME = "wal.loom"
+N = 10000
+
+
+def write_and_crash():
+    db = loom.Dict(FILENAME, flag="n", wal=True, durability="fsync",
+                   lru_cache=0)
+    db.update({f"key_{i}": i for i in range(N)})
+    db.db.flush()
+
+    # the process dies before this group is committed
+    db.db.begin_transaction()
+    db.update({f"lost_{i}": i for i in range(N)})
+    os._exit(1)
+
+
+def check(db, deleted=()):
+    values = db.get_many([f"key_{i}" for i in range(N)])
+    assert values == [None if i in deleted else i for i in range(N)]
+    assert db.get_many([f"lost_{i}" for i in range(N)]) == [None] * N
+
+
+if __name__ == "__main__":
+    process = multiprocessing.Process(target=write_and_crash)
+    process.start()
+    process.join()
+    assert process.exitcode == 1
+
+    # committed groups are replayed from the log when the file is opened
+    db = loom.Dict(FILENAME, wal=True, lru_cache=0)
+    check(db)
+    print("replayed", len(list(db.keys())), "keys")
+
+    deleted = set(range(0, N, 2))
+    for i in deleted:
+        del db[f"key_{i}"]
+    print(db.vacuum(), "bytes reclaimed")
+    check(db, deleted)
+    db.db.close()
+
+    db = loom.Dict(FILENAME, wal=True, lru_cache=0)
+    check(db, deleted)
+    db.db.close()
+    print("ok")
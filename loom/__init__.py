@@ -1 +1,3 @@
 from .database import DB, Dict
+from .aio import AsyncDict
+from .vector import VectorDict
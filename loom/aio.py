@@ -0,0 +1,132 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from .database import Dict
+
+_MISSING = object()
+
+
+class AsyncDict:
+    def __init__(self, filename, max_workers=8, **kwargs):
+        """
+        (str) filename: string name of the database file
+        (int) max_workers: number of threads serving reads
+        (kwargs) kwargs: passed to Dict, which is always opened threadsafe
+
+        Reads run on a bounded thread pool, concurrent lookups of the same
+        key share one future. Writes issued while a batch is pending join
+        it, and each batch is committed in one transaction by a single
+        writer thread, so that batches are applied in order.
+        """
+        kwargs["threadsafe"] = True
+        self.dict = Dict(filename, **kwargs)
+        self._read_executor = ThreadPoolExecutor(max_workers)
+        self._write_executor = ThreadPoolExecutor(1)
+
+        # key to future of the lookups in flight
+        self._reads = {}
+        # writes waiting for the next batch, and batches being committed
+        self._writes = {}
+        self._committing = []
+        self._batch = None
+
+    # -------------------------------------------------------------------------
+    # pending writes
+    # -------------------------------------------------------------------------
+
+    def _get_pending(self, key):
+        # writes not yet committed are seen by reads issued after them
+        value = self._writes.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        for writes in reversed(self._committing):
+            value = writes.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+        return _MISSING
+
+    async def _commit_writes(self):
+        # let the writes issued in the same loop iteration join the batch
+        await asyncio.sleep(0)
+        writes, self._writes = self._writes, {}
+        self._batch = None
+        self._committing.append(writes)
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                self._write_executor, self.dict.set_many,
+                list(writes), list(writes.values()))
+        finally:
+            self._committing.remove(writes)
+
+    # -------------------------------------------------------------------------
+    # public functions
+    # -------------------------------------------------------------------------
+
+    def _lookup(self, key):
+        try:
+            return self.dict[key]
+        except KeyError:
+            return _MISSING
+
+    async def get(self, key, default=None):
+        value = self._get_pending(key)
+        if value is not _MISSING:
+            return value
+
+        future = self._reads.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(
+                self._read_executor, self._lookup, key)
+            self._reads[key] = future
+
+            def forget(_):
+                if self._reads.get(key) is future:
+                    del self._reads[key]
+            future.add_done_callback(forget)
+        # a cancelled caller does not cancel the lookup of the others
+        value = await asyncio.shield(future)
+        return default if value is _MISSING else value
+
+    async def get_many(self, keys, default=None):
+        keys = list(keys)
+        res = [self._get_pending(key) for key in keys]
+        missing = [i for i, value in enumerate(res) if value is _MISSING]
+        if len(missing) > 0:
+            values = await asyncio.get_running_loop().run_in_executor(
+                self._read_executor, self.dict.get_many,
+                [keys[i] for i in missing], _MISSING)
+            for i, value in zip(missing, values):
+                res[i] = value
+        return [default if value is _MISSING else value for value in res]
+
+    async def set(self, key, value):
+        await self.set_many([key], [value])
+
+    async def set_many(self, keys, values):
+        keys = list(keys)
+        self._writes.update(zip(keys, values))
+        # lookups started before the write must not be joined anymore
+        for key in keys:
+            self._reads.pop(key, None)
+        if self._batch is None:
+            self._batch = asyncio.get_running_loop().create_task(
+                self._commit_writes())
+        await asyncio.shield(self._batch)
+
+    async def flush(self):
+        while self._batch is not None:
+            await asyncio.shield(self._batch)
+        await asyncio.get_running_loop().run_in_executor(
+            self._write_executor, self.dict.db.flush)
+
+    async def close(self):
+        await self.flush()
+        self._read_executor.shutdown()
+        self._write_executor.shutdown()
+        self.dict.db.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
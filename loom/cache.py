@@ -0,0 +1,155 @@
+from contextlib import nullcontext
+from threading import RLock
+
+from lru import LRU
+
+from .wal import PAGE_SIZE
+
+LARGE_IO_SIZE = 16 * PAGE_SIZE
+
+
+class PageCache:
+    def __init__(self, read_at, write_at, get_file_size, size,
+                 write_back=False, threadsafe=False):
+        """
+        (function) read_at, write_at: uncached file IO functions
+        (function) get_file_size: returns the current size of the file
+        (int) size: memory budget of the cache in bytes
+        (bool) write_back: keep written pages dirty until flush is called,
+                           instead of writing them through to the file
+        (bool) threadsafe: serialize accesses to the cache with a lock
+        """
+        self._read_at = read_at
+        self._write_at = write_at
+        self._get_file_size = get_file_size
+        self.write_back = write_back
+        self._lock = RLock() if threadsafe else nullcontext()
+
+        self.n_pages = max(size // PAGE_SIZE, 1)
+        self.pages = LRU(self.n_pages, callback=self._evict)
+        self.dirty = set()
+
+        self.hits = 0
+        self.misses = 0
+
+    # -------------------------------------------------------------------------
+    # page management
+    # -------------------------------------------------------------------------
+
+    def _get_page(self, page):
+        buffer = self.pages.get(page)
+        if buffer is not None:
+            self.hits += 1
+            return buffer
+
+        self.misses += 1
+        buffer = bytearray(PAGE_SIZE)
+        data = self._read_at(page * PAGE_SIZE, PAGE_SIZE)
+        buffer[:len(data)] = data
+        self.pages[page] = buffer
+        return buffer
+
+    def _evict(self, page, buffer):
+        if page in self.dirty:
+            self.dirty.discard(page)
+            self._write_pages([(page, buffer)])
+
+    def _write_pages(self, pages):
+        # contiguous pages are written at once, clipped to the end of file
+        file_size = self._get_file_size()
+        start = None
+        chunks = []
+        for page, buffer in pages:
+            page_start = page * PAGE_SIZE
+            if start is not None and \
+                    page_start != start + PAGE_SIZE * len(chunks):
+                self._write_at(start, b"".join(chunks)[:file_size - start])
+                chunks = []
+            if len(chunks) == 0:
+                start = page_start
+            chunks.append(buffer)
+        if start is not None and start < file_size:
+            self._write_at(start, b"".join(chunks)[:file_size - start])
+
+    def _flush_pages(self, first, last):
+        pages = [p for p in self.dirty if first <= p <= last]
+        if len(pages) == 0:
+            return
+        pages.sort()
+        self.dirty.difference_update(pages)
+        self._write_pages([(p, self.pages[p]) for p in pages])
+
+    def flush(self):
+        with self._lock:
+            if len(self.dirty) == 0:
+                return
+            pages = sorted(self.dirty)
+            self.dirty.clear()
+            self._write_pages([(p, self.pages[p]) for p in pages])
+
+    def clear(self):
+        with self._lock:
+            self.flush()
+            self.pages.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.,
+            "pages": len(self.pages),
+            "dirty_pages": len(self.dirty),
+            "capacity_pages": self.n_pages,
+        }
+
+    # -------------------------------------------------------------------------
+    # IO functions
+    # -------------------------------------------------------------------------
+
+    def read_at(self, start, size):
+        with self._lock:
+            first = start // PAGE_SIZE
+            last = (start + size - 1) // PAGE_SIZE
+            if size > LARGE_IO_SIZE or last < first:
+                # large reads go to the file and do not evict hot pages
+                self._flush_pages(first, last)
+                return self._read_at(start, size)
+
+            offset = start - first * PAGE_SIZE
+            if first == last:
+                return memoryview(
+                    self._get_page(first))[offset:offset + size].tobytes()
+            data = b"".join(
+                [self._get_page(p) for p in range(first, last + 1)])
+            return data[offset:offset + size]
+
+    def write_at(self, index, data):
+        with self._lock:
+            data = memoryview(data).cast("B")
+            size = len(data)
+            first = index // PAGE_SIZE
+            last = (index + size - 1) // PAGE_SIZE
+            if last < first:
+                return
+
+            if not self.write_back or size > LARGE_IO_SIZE:
+                self._flush_pages(first, last)
+                self._write_at(index, data)
+
+            # update the cached copies, loading pages only when writing back
+            end = index + size
+            position = 0
+            while index < end:
+                page, offset = divmod(index, PAGE_SIZE)
+                length = min(PAGE_SIZE - offset, end - index)
+                if self.write_back and size <= LARGE_IO_SIZE:
+                    buffer = self._get_page(page)
+                    self.dirty.add(page)
+                else:
+                    buffer = self.pages.get(page)
+                if buffer is not None:
+                    buffer[offset:offset + length] = \
+                        data[position:position + length]
+                index += length
+                position += length
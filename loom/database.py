@@ -1,13 +1,25 @@
+import mmap
 import os
 import pickle
+import threading
+import time
 
-from numpy import array, dtype, frombuffer, int8, uint32, ceil
+import mmh3
+from numpy import (array, ceil, dtype, frombuffer, int8, ndarray, uint32,
+                   uint64)
 
 from .dataset import Array, BoolArray, Dataset, Group, blob_dt
-from .exception import DatasetExistsError, HeaderExistsError
+from .exception import (DatabaseLockedError, DatasetExistsError,
+                        HeaderExistsError)
 from .datastructure.array import List
+from .cache import PageCache
+from .search import (_check_metric, _get_block_chunks, _merge,
+                     _search_spans, _to_queries)
+from .stats import Histogram, _get_lru_stats, to_prometheus
+from .wal import PAGE_SIZE, WriteAheadLog
 
 STEP_SIZE = 4096
+READ_RETRY_DELAY = 0.001
 
 
 class DB:
@@ -17,14 +29,77 @@ class DB:
         flag="w",
         blob_protocol="pickle",
         blob_compression=None,
+        io="file",
+        durability="flush",
+        wal=False,
+        wal_group_bytes=2**20,
+        wal_group_ms=100,
+        cache_size=0,
+        cache_policy="write-through",
+        threadsafe=False,
+        shared=False,
+        timing=False,
     ):
         """
         (str) filename: string name of the database file
         (str) flag: 'w' for write, 'r' for read and 'n' for new
         (str) blob_protocol: protocol defining encoding and decoding functions
+        (str) io: 'file' for seek+read/write calls, 'mmap' to map the file in
+                  memory; mmap reads copy the bytes out of the mapping, so
+                  that returned values never change with the file
+        (str) durability: 'none' or 'flush' to hand writes to the OS on
+                          commit and leave flushing them to disk to the OS,
+                          'fsync' to sync them to disk
+        (bool) wal: log writes to a write-ahead log committed in groups
+        (int) wal_group_bytes: commit the log once this many bytes are dirty
+        (int) wal_group_ms: commit the log once its oldest write is this old,
+                            a timer thread committing it when no other
+                            write follows if the file is threadsafe,
+                            otherwise the next write, flush or close does
+        (int) cache_size: memory budget in bytes of the page cache placed
+                          under file reads and writes, 0 to disable it
+        (str) cache_policy: 'write-through', or 'write-back' to keep written
+                            pages in the cache until the transaction commits
+        (bool) threadsafe: allow any number of threads to read while writes
+                           are serialized by a lock, file reads then use
+                           positional IO instead of seek+read
+        (bool) shared: the file is written by one process and read by others,
+                       the writer holds an exclusive lock on the file and
+                       publishes a generation counter that readers check
+                       to refresh their state and retry overlapping reads
+        (bool) timing: record histograms of the durations of reads and
+                       writes, the other counters are always kept
         """
+        if durability not in ("none", "flush", "fsync"):
+            raise ValueError(f"Durability {durability} unknown")
+        if shared and cache_policy == "write-back":
+            raise ValueError("A shared file requires a write-through cache")
         self.filename = filename
+        self.durability = durability
+        self.blob_protocol = blob_protocol
+        self.blob_compression = blob_compression
         self._get_encoder_and_decoder(blob_protocol, blob_compression)
+        self._threadsafe = threadsafe
+        self._shared = shared
+        self._shared_writer = False
+        self._generation_index = None
+        self._generation_map = None
+        self.generation = 0
+        self._lock = threading.RLock() if threadsafe else None
+        self._stats = dict.fromkeys((
+            "read_calls", "read_bytes", "write_calls", "write_bytes",
+            "commits", "flushes", "syncs", "wal_groups", "blob_appends",
+            "blob_block_scans", "blob_new_blocks", "blob_extents"), 0)
+        self._timing = timing
+        if timing:
+            self._read_seconds = Histogram(1e-9)
+            self._write_seconds = Histogram(1e-9)
+        # readers of a shared file use positional IO too, so that no read
+        # buffer holds bytes the writer has changed since
+        self._get_io_methods(io, wal and flag != "r", cache_size, cache_policy,
+                             threadsafe or (shared and flag == "r"))
+        self._wal_group_bytes = wal_group_bytes
+        self._wal_group_ms = wal_group_ms
 
         self._id2size = {}
         self._id2dataset = {}
@@ -34,6 +109,7 @@ class DB:
         self.datasets = {}
         self.datastructures = {}
         self.commit = True
+        self._transaction_depth = 0
 
         # blob management variables
         self._block_size = 4096*4
@@ -41,36 +117,131 @@ class DB:
         self._n_slots_per_block = self._block_size // self._slot_size
 
         # internal list of header fields
-        self._header_fields = {"_index": dtype("uint64")}
+        self._header_fields = {"_index": dtype("uint64"),
+                               "_generation": dtype("uint64")}
 
-        # index of read/write head
-        self._index = None
+        # header values held in memory, written back when committing
+        self._header_values = {}
+        self._dirty_header = set()
         self._blob_identifier = int8(1).tobytes()
 
         # open file
         self.flag = flag
-        if flag == "n" and os.path.exists(filename):
-            os.remove(filename)
+        if flag == "n":
+            for name in (filename, self._wal_filename):
+                if os.path.exists(name):
+                    os.remove(name)
         self.open()
 
     def begin_transaction(self):
+        # transactions nest, only the outermost one commits, and the writer
+        # lock is held until it does
+        if self._lock is not None:
+            self._lock.acquire()
+        if self._transaction_depth == 0 and self._shared_writer and \
+                self._wal is None:
+            self._write_generation(self.generation + 1)
+        self._transaction_depth += 1
         self.commit = False
 
     def end_transaction(self):
-        self.commit = True
-        self.f.flush()
+        try:
+            self._transaction_depth = max(self._transaction_depth - 1, 0)
+            if self._transaction_depth != 0:
+                return
+            self._flush_header()
+            if self._shared_writer and self._wal is None:
+                self._write_generation(self.generation + 1)
+            self._stats["commits"] += 1
+            self.commit = True
+            if self._wal is not None:
+                self._maybe_commit_group()
+            else:
+                self._sync()
+        finally:
+            if self._lock is not None:
+                self._lock.release()
+
+    def flush(self):
+        if self._lock is not None:
+            self._lock.acquire()
+        try:
+            self._stats["flushes"] += 1
+            self._flush_header()
+            if self._wal is not None:
+                self._commit_group()
+            self._sync()
+        finally:
+            if self._lock is not None:
+                self._lock.release()
 
     def open(self):
         # create new file if needed, else open in rb+ mode
         if self._is_new_database():
             self.f = open(self.filename, "wb+")
+            self._lock_file()
+            self._open_wal()
+            self._remap()
         elif self.flag != "r":
             self.f = open(self.filename, "rb+")
+            self._lock_file()
+            self._open_wal()
+            self._remap()
             self._load()
         else:
             self.f = open(self.filename, "rb")
+            self._remap()
             self._load()
 
+    def _get_io_methods(self, io, wal, cache_size=0,
+                        cache_policy="write-through", positional=False):
+        self.io = io
+        self._mmap = None
+        self._view = None
+        if io == "file" and positional:
+            self._raw_read_at = self._pread_read_at
+            self._raw_write_at = self._pwrite_write_at
+        elif io == "file":
+            self._raw_read_at = self._file_read_at
+            self._raw_write_at = self._file_write_at
+        elif io == "mmap":
+            self._raw_read_at = self._mmap_read_at
+            self._raw_write_at = self._mmap_write_at
+        else:
+            raise ValueError(f"IO mode {io} unknown")
+
+        self.page_cache = None
+        if cache_size > 0:
+            if io != "file":
+                raise ValueError("The page cache requires io='file'")
+            if cache_policy not in ("write-through", "write-back"):
+                raise ValueError(f"Cache policy {cache_policy} unknown")
+            self.page_cache = PageCache(
+                self._raw_read_at, self._raw_write_at,
+                lambda: self.file_size, cache_size,
+                write_back=cache_policy == "write-back",
+                threadsafe=self._threadsafe)
+            self._raw_read_at = self.page_cache.read_at
+            self._raw_write_at = self.page_cache.write_at
+
+        self._use_wal = wal
+        self._wal = None
+        self._pages = {}
+        self._group_start = None
+        self._group_timer = None
+        if wal:
+            self._io_read_at = self._wal_read_at
+            self._io_write_at = self._wal_write_at
+        else:
+            self._io_read_at = self._raw_read_at
+            self._io_write_at = self._commit_write_at
+        if self._timing:
+            self._read_at = self._timed_read_at
+            self._write_at = self._timed_write_at
+        else:
+            self._read_at = self._counted_read_at
+            self._write_at = self._counted_write_at
+
     def _get_encoder_and_decoder(self, blob_protocol, blob_compression):
         # available compressions
         if blob_compression is None:
@@ -100,11 +271,13 @@ class DB:
         elif blob_protocol == "ujson":
             import ujson
             dumps = ujson.dumps
-            loads = ujson.loads
+
+            def loads(x): return ujson.loads(bytes(x))
         elif blob_protocol == "cbor":
             import cbor2
             dumps = cbor2.dumps
-            loads = cbor2.loads
+
+            def loads(x): return cbor2.loads(bytes(x))
 
         self.encode = lambda x: compress(dumps(x))
         self.decode = lambda x: loads(decompress(x))
@@ -113,6 +286,10 @@ class DB:
     # properties
     # -------------------------------------------------------------------------
 
+    @property
+    def _wal_filename(self):
+        return f"{self.filename}.wal"
+
     @property
     def file_size(self):
         return os.stat(self.filename).st_size
@@ -123,17 +300,11 @@ class DB:
 
     @property
     def index(self):
-        if self._index is None:
-            res = self.header._get_field_no_index("_index")
-            self._index = res
-            return res
-        return self._index
+        return self._get_header("_index")
 
     @index.setter
     def index(self, value):
-        value = int(value)
-        self.header._set_field_no_index("_index", value)
-        self._index = value
+        self._set_header("_index", int(value))
 
     @property
     def _n_empty_slots(self):
@@ -152,6 +323,24 @@ class DB:
         for datastructure in self.datastructures.values():
             datastructure._initialize()
 
+    def _get_header(self, key):
+        value = self._header_values.get(key)
+        if value is None:
+            value = self.header._get_field_no_index(key)
+            self._header_values[key] = value
+        return value
+
+    def _set_header(self, key, value):
+        self._header_values[key] = value
+        self._dirty_header.add(key)
+        if self.commit:
+            self._flush_header()
+
+    def _flush_header(self):
+        for key in self._dirty_header:
+            self.header._set_field_no_index(key, self._header_values[key])
+        self._dirty_header.clear()
+
     def _remove_database_reference(self):
         self.header._remove_database_reference()
         for name in self.datasets:
@@ -202,9 +391,8 @@ class DB:
         self.index = self.file_size
 
     def _load(self):
-        self.f.seek(0)
-        data_len = frombuffer(self.f.read(4), dtype=uint32)[0]
-        data = pickle.loads(self.f.read(data_len))
+        data_len = int(frombuffer(self._read_at(0, 4), dtype=uint32)[0])
+        data = pickle.loads(self._read_at(4, data_len))
         # grab values if not already done
         if self.header is None:
             self.header = data["header"]
@@ -217,15 +405,18 @@ class DB:
         self._add_database_reference()
 
         # initialize heads
+        self._header_values = {}
+        self._dirty_header = set()
         self.header._offset = data_len + 4
         self.table_start = self.header._offset + len(self.header)
 
+        self._load_generation()
+
         # initialize datastructures
         for dstruct in self.datastructures.values():
             dstruct._load()
 
-        self._slots = [self._blocks_list[i]
-                       for i in range(len(self._blocks_list))]
+        self._load_blocks()
 
     def create_dataset(self, name, **kwargs):
         if name in self.datasets:
@@ -286,6 +477,8 @@ class DB:
 
         if "_index" not in self._header_fields:
             self._header_fields["_index"] = dtype("uint64")
+        if "_generation" not in self._header_fields:
+            self._header_fields["_generation"] = dtype("uint64")
 
         for field, dt in fields.items():
             self._header_fields[field] = dtype(dt)
@@ -313,7 +506,7 @@ class DB:
     def compile(self):
         # create block list for blob management
         _blocks = self.create_dataset(
-            "blocks", position="uint64", slots_taken="uint8")
+            "blocks", position="uint64", slots_taken="uint16")
         self.create_datastructure("_blocks_list", List(_blocks))
 
         self._dump()
@@ -324,40 +517,78 @@ class DB:
     # blob manipulation methods
     # -------------------------------------------------------------------------
 
+    def _load_blocks(self):
+        self._slots = [
+            {"position": int(slot["position"]),
+             "slots_taken": int(slot["slots_taken"])}
+            for slot in self._blocks_list[:]]
+
+        # blocks with free slots, indexed by size class: class c holds the
+        # blocks having between 2**c and 2**(c+1) - 1 free slots
+        self._free_blocks = [
+            [] for _ in range(self._n_slots_per_block.bit_length())]
+        self._current_block = len(self._slots) - 1
+        for i in range(self._current_block):
+            self._release_block(i)
+
+    def _release_block(self, i):
+        free = self._n_slots_per_block - self._slots[i]["slots_taken"]
+        if free > 0:
+            self._free_blocks[free.bit_length() - 1].append(i)
+
+    def _find_block(self, n_slots):
+        # the current block is filled first, then any block of a size class
+        # large enough to hold n_slots, and a new block is allocated last
+        i = self._current_block
+        if i >= 0:
+            free = self._n_slots_per_block - self._slots[i]["slots_taken"]
+            if free >= n_slots:
+                return i
+        for size_class in range((n_slots - 1).bit_length(),
+                                len(self._free_blocks)):
+            self._stats["blob_block_scans"] += 1
+            if len(self._free_blocks[size_class]) != 0:
+                return self._free_blocks[size_class].pop()
+        return self._new_block()
+
+    def _new_block(self):
+        if self._current_block >= 0:
+            self._release_block(self._current_block)
+        self._stats["blob_new_blocks"] += 1
+        index = self._allocate(self._block_size)
+        slot = {"position": index, "slots_taken": 0}
+        self._slots.append(slot)
+        self._blocks_list.append(slot)
+        self._current_block = len(self._slots) - 1
+        return self._current_block
+
     def _append(self, data_bytes):
+        self._stats["blob_appends"] += 1
         data_size = len(data_bytes)
+        if data_size > self._block_size:
+            return self._append_extent(data_bytes)
         n_slots = int(ceil(data_size / self._slot_size))
-        assert data_size <= self._block_size
 
-        if len(self._slots) == 0:
-            # allocate a new block
-            index = self._allocate(self._block_size)
+        self.begin_transaction()
+        try:
+            i = self._find_block(n_slots)
+            slot = self._slots[i]
+            index = slot["position"] + self._slot_size * slot["slots_taken"]
             self._write_at(index, data_bytes)
+            slot["slots_taken"] += n_slots
+            self._blocks_list[i] = slot
+        finally:
+            self.end_transaction()
+        if i != self._current_block:
+            self._release_block(i)
+        return index
 
-            slot = {"position": index, "slots_taken": n_slots}
-            self._slots = [slot]
-            self._blocks_list.append(slot)
-        else:
-            _slot_found = False
-            for i, slot in enumerate(self._slots):
-                slots_in_block = self._n_slots_per_block + i
-                if slots_in_block - slot["slots_taken"] < n_slots:
-                    continue
-                _slot_found = True
-                index = slot["position"] + self._slot_size * slot["slots_taken"]
-
-                self._write_at(index, data_bytes)
-                slot["slots_taken"] += n_slots
-                self._blocks_list[i] = slot
-            if not _slot_found:
-                # allocate a new block
-                slots_in_block = self._n_slots_per_block + len(self._slots)
-                index = self._allocate(self._slot_size * slots_in_block)
-                self._write_at(index, data_bytes)
-
-                slot = {"position": index, "slots_taken": n_slots}
-                self._slots.append(slot)
-                self._blocks_list.append(slot)
+    def _append_extent(self, data_bytes):
+        # data larger than a block gets its own contiguous extent, the blob
+        # header already stores its length so reads stay a single call
+        self._stats["blob_extents"] += 1
+        index = self._allocate(len(data_bytes))
+        self._write_at(index, data_bytes)
         return index
 
     def append_blob(self, blob):
@@ -373,10 +604,179 @@ class DB:
 
     def get_blob(self, index):
         byte_index = index + 1
-        size = frombuffer(self._read_at(byte_index, 4), dtype=uint32)[0]
-        blob_bytes = self.f.read(size)
+        size = int(frombuffer(self._read_at(byte_index, 4), dtype=uint32)[0])
+        blob_bytes = self._read_at(byte_index + 4, size)
         return self.decode(blob_bytes)
 
+    def _get_blob_bytes(self, index):
+        # identifier, size and content of a blob, as they were appended
+        size = int(frombuffer(self._read_at(index + 1, 4), dtype=uint32)[0])
+        return self._read_at(index, size + 5)
+
+    # -------------------------------------------------------------------------
+    # compaction
+    # -------------------------------------------------------------------------
+
+    def compact(self):
+        """
+        Rewrites the rows held by the datastructures, and the blobs they
+        reference, into a new file that replaces this one: deleted keys,
+        overwritten blobs and tables emptied by migrations are left behind.
+        Returns the number of bytes reclaimed.
+
+        Other threads must not use the instance meanwhile, and reader
+        processes of a shared file have to open it again.
+        """
+        if self.flag == "r":
+            raise ValueError("A file opened read-only cannot be compacted")
+        names = {name for dstruct in self.datastructures.values()
+                 for name in dstruct._get_dataset_names()}
+        for name in self.datasets:
+            if name not in names:
+                raise ValueError(
+                    f"Dataset '{name}' is not held by a datastructure "
+                    "and cannot be compacted")
+        for name, dstruct in self.datastructures.items():
+            if (dstruct is not self._blocks_list and
+                    not hasattr(dstruct, "_copy_from")):
+                raise ValueError(
+                    f"Datastructure '{name}' of type "
+                    f"{type(dstruct).__name__} cannot be compacted")
+
+        if self._lock is not None:
+            self._lock.acquire()
+        try:
+            self.flush()
+            file_size = self.file_size
+            filename = f"{self.filename}.compact"
+            try:
+                self._write_compacted(filename)
+            except BaseException:
+                if os.path.exists(filename):
+                    os.remove(filename)
+                raise
+            self.close()
+            os.replace(filename, self.filename)
+            self.open()
+            return file_size - self.file_size
+        finally:
+            if self._lock is not None:
+                self._lock.release()
+
+    def _write_compacted(self, filename):
+        # the metadata and the header are kept, with the header fields of
+        # the datastructures reset so that they start empty in the new file
+        data = bytearray(self._read_at(0, self.table_start))
+        fields = {"_index"}
+        for dstruct in self.datastructures.values():
+            fields.update(dstruct._get_header_fields())
+        for key in fields:
+            _, size, align, dt = self.header._field[key]
+            value = self.table_start if key == "_index" else 0
+            start = self.header._offset + align
+            data[start:start + size] = array(value, dtype=dt).tobytes()
+        with open(filename, "wb") as f:
+            f.write(data)
+
+        # blobs are appended again while the rows are copied
+        db = DB(filename, durability=self.durability)
+        try:
+            db.begin_transaction()
+            try:
+                for name, dstruct in self.datastructures.items():
+                    if dstruct is not self._blocks_list:
+                        db.datastructures[name]._copy_from(dstruct)
+            finally:
+                db.end_transaction()
+        finally:
+            db.close()
+
+    # -------------------------------------------------------------------------
+    # vector search
+    # -------------------------------------------------------------------------
+
+    def search(self, dataset, field, query, k=10, metric="dot", blocks=None,
+               chunk_rows=2**16, workers=None):
+        """
+        (str or Dataset) dataset: dataset holding the vectors
+        (str) field: field of the vectors, as '(100,)float32'
+        (ndarray) query: (dim,) vector or (n_queries, dim) array
+        (int) k: number of results per query
+        (str) metric: 'dot' for the largest dot products, 'l2' for the
+                      smallest squared L2 distances
+        (list) blocks: (block_id, n_rows) blocks to search, row ids counting
+                       rows across them in order, by default the rows of the
+                       List holding the dataset, ids being their positions
+        (int) chunk_rows: rows read at once
+        (int) workers: threads scoring the chunks, os.cpu_count() if None
+
+        Scans every row, see datastructure.IVF for an approximate index.
+        Returns the scores and ids of the k best rows, best first, as
+        arrays of shape (k,) or (n_queries, k); where fewer than k rows
+        were found, the remaining ids are -1 and their scores -inf for dot
+        and +inf for l2.
+        """
+        if self._generation_map is not None:
+            return self._read_consistent(
+                self._search, dataset, field, query, k, metric, blocks,
+                chunk_rows, workers)
+        return self._search(dataset, field, query, k, metric, blocks,
+                            chunk_rows, workers)
+
+    def _search(self, dataset, field, query, k, metric, blocks, chunk_rows,
+                workers):
+        if isinstance(dataset, str):
+            dataset = self.datasets[dataset]
+        _check_metric(metric)
+        queries, single = _to_queries(
+            query, dataset._field[field][3].shape[0])
+        if blocks is None:
+            spans = self._get_list_chunks(dataset, chunk_rows)
+        else:
+            spans = _get_block_chunks(blocks, chunk_rows)
+        results = _search_spans(
+            dataset, field, ((*span, None) for span in spans), queries,
+            metric, k, workers)
+        return _merge(results, len(queries), k, metric, single)
+
+    def _get_list_chunks(self, dataset, chunk_rows):
+        for dstruct in self.datastructures.values():
+            if isinstance(dstruct, List) and dstruct.dataset is dataset:
+                return dstruct._get_chunks(0, len(dstruct), chunk_rows)
+        raise ValueError(
+            f"Dataset '{dataset.name}' is not held by a List, "
+            "its blocks have to be given")
+
+    # -------------------------------------------------------------------------
+    # statistics
+    # -------------------------------------------------------------------------
+
+    def stats(self):
+        """
+        Returns the counters of the database, of its page cache and of its
+        datastructures, as dicts of counters and histograms by component.
+        """
+        res = {"db": dict(self._stats)}
+        if self._timing:
+            res["db"]["read_seconds"] = self._read_seconds.to_dict()
+            res["db"]["write_seconds"] = self._write_seconds.to_dict()
+        if self.page_cache is not None:
+            res["page_cache"] = self.page_cache.stats()
+        for name, dstruct in self.datastructures.items():
+            stats = dstruct._get_stats()
+            if stats:
+                res[name.lstrip("_")] = stats
+        return res
+
+    def stats_prometheus(self, prefix="loom"):
+        """
+        (str) prefix: prefix of the metric names
+
+        Returns the stats in the Prometheus text format, labelled with the
+        name of the file.
+        """
+        return to_prometheus(self.stats(), prefix, {"file": self.filename})
+
     # -------------------------------------------------------------------------
     # file IO management methods
     # -------------------------------------------------------------------------
@@ -393,18 +793,365 @@ class DB:
 
     def _extend_file(self, bytes_size):
         self.f.truncate(self.file_size + bytes_size)
+        self._remap()
 
-    def _write_at(self, index, data):
+    def _file_write_at(self, index, data):
         self.f.seek(index)
         self.f.write(data)
-        if self.commit:
-            self.f.flush()
 
-    def _read_at(self, start, size):
+    def _file_read_at(self, start, size):
         self.f.seek(start)
         return self.f.read(size)
 
+    def _pwrite_write_at(self, index, data):
+        os.pwrite(self.f.fileno(), data, index)
+
+    def _pread_read_at(self, start, size):
+        return os.pread(self.f.fileno(), size, start)
+
+    def _counted_read_at(self, start, size):
+        stats = self._stats
+        stats["read_calls"] += 1
+        stats["read_bytes"] += size
+        return self._io_read_at(start, size)
+
+    def _counted_write_at(self, index, data):
+        stats = self._stats
+        stats["write_calls"] += 1
+        stats["write_bytes"] += len(data)
+        self._io_write_at(index, data)
+
+    def _timed_read_at(self, start, size):
+        begin = time.perf_counter_ns()
+        data = self._counted_read_at(start, size)
+        self._read_seconds.add(time.perf_counter_ns() - begin)
+        return data
+
+    def _timed_write_at(self, index, data):
+        begin = time.perf_counter_ns()
+        self._counted_write_at(index, data)
+        self._write_seconds.add(time.perf_counter_ns() - begin)
+
+    def _commit_write_at(self, index, data):
+        self._raw_write_at(index, data)
+        if self.commit:
+            self._sync()
+
+    def _sync(self):
+        # writes always reach the OS, so that the log can be emptied once
+        # they did, durability only decides whether they are synced to disk;
+        # writes to the mapping are already visible to the OS
+        self._stats["syncs"] += 1
+        if self.page_cache is not None:
+            self.page_cache.flush()
+        if self._mmap is None:
+            self.f.flush()
+        if self.durability == "fsync":
+            if self._mmap is not None:
+                self._mmap.flush()
+            os.fsync(self.f.fileno())
+
+    # -------------------------------------------------------------------------
+    # memory-mapped IO methods
+    # -------------------------------------------------------------------------
+
+    def _remap(self):
+        if self.io != "mmap":
+            return
+        size = self.file_size
+        if size == 0 or (self._mmap is not None and len(self._mmap) == size):
+            return
+
+        # the previous mapping is left to the garbage collector when other
+        # threads may still be reading from it
+        if not self._threadsafe:
+            self._unmap()
+        self.f.flush()
+        if self.flag == "r":
+            new_mmap = mmap.mmap(
+                self.f.fileno(), size, access=mmap.ACCESS_READ)
+        else:
+            new_mmap = mmap.mmap(self.f.fileno(), size)
+        self._mmap, self._view = new_mmap, memoryview(new_mmap)
+
+    def _unmap(self):
+        if self._mmap is None:
+            return
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass
+        self._mmap = None
+        self._view = None
+
+    def _mmap_write_at(self, index, data):
+        self._view[index:index + len(data)] = data
+
+    def _mmap_read_at(self, start, size):
+        # a copy, as the bytes read from a file: arrays parsed from a view
+        # would write to the mapping behind the log and the transactions,
+        # and change when the rows they came from are overwritten
+        return self._mmap[start:start + size]
+
+    # -------------------------------------------------------------------------
+    # multi-process methods
+    # -------------------------------------------------------------------------
+
+    def _lock_file(self):
+        if not self._shared:
+            return
+        import fcntl
+        try:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.f.close()
+            raise DatabaseLockedError(
+                f"{self.filename} is already opened by a writer")
+
+    def _load_generation(self):
+        # the writer makes the counter odd while it writes to the file and
+        # even once it is done, readers map the bytes holding it
+        if not self._shared:
+            return
+        if "_generation" not in self.header._field:
+            raise ValueError(
+                "Sharing requires a file created with a generation counter")
+        self._generation_index = (
+            self.header._offset + self.header._field["_generation"][2])
+        if self.flag == "r":
+            self._generation_map = mmap.mmap(
+                self.f.fileno(), self._generation_index + 8,
+                access=mmap.ACCESS_READ)
+            self.generation = self._read_generation()
+        else:
+            # a writer that crashed may have left the counter odd
+            self._shared_writer = True
+            generation = int(self.header._get_field_no_index("_generation"))
+            self._write_generation(generation + generation % 2)
+
+    def _read_generation(self):
+        index = self._generation_index
+        return int.from_bytes(
+            self._generation_map[index:index + 8], "little")
+
+    def _write_generation(self, generation):
+        # written to the file right away, and into the dirty pages of the
+        # log so that committing them does not bring back an older value
+        self.generation = generation
+        index = self._generation_index
+        data = uint64(generation).tobytes()
+        for page in {index // PAGE_SIZE, (index + 7) // PAGE_SIZE}:
+            buffer = self._pages.get(page)
+            if buffer is not None:
+                a = max(index, page * PAGE_SIZE)
+                b = min(index + 8, (page + 1) * PAGE_SIZE)
+                buffer[a - page * PAGE_SIZE:b - page * PAGE_SIZE] = \
+                    data[a - index:b - index]
+        self._raw_write_at(index, data)
+        if self._mmap is None:
+            self.f.flush()
+
+    def _map_region(self, start, size):
+        # read-only view of file bytes that follows the commits of the
+        # writer process without reading them again
+        offset = start - start % mmap.ALLOCATIONGRANULARITY
+        region = mmap.mmap(self.f.fileno(), start + size - offset,
+                           access=mmap.ACCESS_READ, offset=offset)
+        return memoryview(region)[start - offset:]
+
+    def refresh(self):
+        """
+        Reloads the state held in memory when the writer process committed
+        since the last call, and returns the current generation.
+        """
+        if self._generation_map is None:
+            return self.generation
+        generation = self._read_generation()
+        if generation == self.generation or generation % 2 == 1:
+            return generation
+
+        self.generation = generation
+        self._remap()
+        if self.page_cache is not None:
+            self.page_cache.clear()
+        self._header_values = {}
+        for dstruct in self.datastructures.values():
+            dstruct._refresh()
+        return generation
+
+    def _read_consistent(self, fn, *args, **kwargs):
+        # reads overlapping a commit of the writer process are retried
+        while True:
+            generation = self.refresh()
+            if generation % 2 == 0:
+                try:
+                    res, error = fn(*args, **kwargs), None
+                except Exception as e:
+                    res, error = None, e
+                if self._read_generation() == generation:
+                    if error is not None:
+                        raise error
+                    return res
+            time.sleep(READ_RETRY_DELAY)
+
+    # -------------------------------------------------------------------------
+    # write-ahead log methods
+    # -------------------------------------------------------------------------
+
+    def _open_wal(self):
+        # committed groups left by a crash are applied before loading
+        if os.path.exists(self._wal_filename):
+            wal = WriteAheadLog(self._wal_filename, self.durability)
+            wal.replay(self.f)
+            if not self._use_wal:
+                wal.close()
+                os.remove(self._wal_filename)
+                return
+            self._wal = wal
+        elif self._use_wal:
+            self._wal = WriteAheadLog(self._wal_filename, self.durability)
+
+    def _get_dirty_page(self, page):
+        buffer = self._pages.get(page)
+        if buffer is None:
+            if len(self._pages) == 0:
+                self._group_start = time.monotonic()
+                if self._threadsafe:
+                    self._start_group_timer()
+            buffer = bytearray(PAGE_SIZE)
+            data = self._raw_read_at(page * PAGE_SIZE, PAGE_SIZE)
+            buffer[:len(data)] = data
+            self._pages[page] = buffer
+        return buffer
+
+    def _wal_write_at(self, index, data):
+        # writes stay in dirty pages until their group is in the log
+        data = memoryview(data).cast("B")
+        end = index + len(data)
+        position = 0
+        while index < end:
+            page, offset = divmod(index, PAGE_SIZE)
+            size = min(PAGE_SIZE - offset, end - index)
+            buffer = self._get_dirty_page(page)
+            buffer[offset:offset + size] = data[position:position + size]
+            index += size
+            position += size
+        if self._transaction_depth == 0:
+            self._maybe_commit_group()
+
+    def _wal_read_at(self, start, size):
+        # the dirty pages are taken before reading the file, so that a group
+        # committed meanwhile by another thread is still seen
+        dirty_pages = self._pages
+        data = self._raw_read_at(start, size)
+        if len(dirty_pages) == 0 or size == 0:
+            return data
+
+        first = start // PAGE_SIZE
+        last = (start + size - 1) // PAGE_SIZE
+        if last - first < len(dirty_pages):
+            pages = [p for p in range(first, last + 1) if p in dirty_pages]
+        else:
+            pages = [p for p in list(dirty_pages) if first <= p <= last]
+        if len(pages) == 0:
+            return data
+
+        # patch the file content with the dirty pages it overlaps
+        data = bytearray(data)
+        for page in pages:
+            page_start = page * PAGE_SIZE
+            a = max(start, page_start)
+            b = min(start + size, page_start + PAGE_SIZE)
+            data[a - start:b - start] = \
+                dirty_pages[page][a - page_start:b - page_start]
+        return bytes(data)
+
+    def _maybe_commit_group(self):
+        if len(self._pages) == 0:
+            return
+        elapsed_ms = (time.monotonic() - self._group_start) * 1000
+        if (len(self._pages) * PAGE_SIZE >= self._wal_group_bytes or
+                elapsed_ms >= self._wal_group_ms):
+            self._commit_group()
+
+    def _start_group_timer(self):
+        # commits the group once its window expires, unless it was before
+        timer = threading.Timer(self._wal_group_ms / 1000,
+                                self._commit_expired_group,
+                                args=(self._group_start,))
+        timer.daemon = True
+        self._group_timer = timer
+        timer.start()
+
+    def _commit_expired_group(self, group_start):
+        with self._lock:
+            if self._wal is None or len(self._pages) == 0 or \
+                    self._group_start != group_start:
+                return
+            self._commit_group()
+
+    def _commit_group(self):
+        if self._group_timer is not None:
+            self._group_timer.cancel()
+            self._group_timer = None
+        if len(self._pages) == 0:
+            return
+
+        # contiguous dirty pages are logged and written as one record,
+        # clipped to the end of the file
+        file_size = self.file_size
+        records = []
+        start = None
+        chunks = []
+        for page in sorted(self._pages):
+            page_start = page * PAGE_SIZE
+            if start is not None and page_start != start + PAGE_SIZE * len(
+                    chunks):
+                records.append((start, b"".join(chunks)))
+                chunks = []
+            if len(chunks) == 0:
+                start = page_start
+            chunks.append(self._pages[page])
+        records.append((start, b"".join(chunks)))
+        records = [(index, data[:file_size - index])
+                   for index, data in records if index < file_size]
+
+        self._wal.write_group(records)
+        self._stats["wal_groups"] += 1
+        if self._shared_writer:
+            self._write_generation(self.generation + 1)
+        for index, data in records:
+            self._raw_write_at(index, data)
+        if self._shared_writer:
+            self._write_generation(self.generation + 1)
+        self._sync()
+        self._wal.truncate()
+        self._pages = {}
+
     def close(self):
+        if not hasattr(self, "f"):
+            return
+        # waits for a group being committed by its timer
+        if self._lock is not None:
+            with self._lock:
+                self._close()
+        else:
+            self._close()
+
+    def _close(self):
+        if len(self._dirty_header) != 0 and not self.f.closed:
+            self._flush_header()
+        if self._wal is not None and not self.f.closed:
+            self._commit_group()
+            self._wal.close()
+            self._wal = None
+        if self.page_cache is not None and not self.f.closed:
+            self.page_cache.clear()
+        self._unmap()
+        if self._generation_map is not None:
+            self._generation_map.close()
+            self._generation_map = None
         self.f.close()
 
     def __del__(self):
@@ -420,18 +1167,44 @@ class Dict:
         max_key_len=30,
         blob_compression=None,
         blob_protocol="pickle",
+        io="file",
+        durability="flush",
+        wal=False,
+        cache_size=0,
+        cache_policy="write-through",
+        threadsafe=False,
+        shared=False,
         cache_len=100000,
         lru_cache=10000,
         p_init=16,
-        probe_factor=.4
+        probe_factor=.4,
+        migrate_buckets=0,
+        timing=False,
+        verify_keys=False
     ):
         from .datastructure import Hashmap
+        if verify_keys and not use_hash:
+            raise ValueError("Verified keys are stored with their hash")
         if not os.path.exists(filename) or flag == "n":
             self.db = DB(filename, flag=flag,
                          blob_compression=blob_compression,
-                         blob_protocol=blob_protocol)
-            self.db.create_header(max_key_len="uint8", use_hash="bool")
-            if use_hash:
+                         blob_protocol=blob_protocol,
+                         io=io,
+                         durability=durability,
+                         wal=wal,
+                         cache_size=cache_size,
+                         cache_policy=cache_policy,
+                         threadsafe=threadsafe,
+                         shared=shared,
+                         timing=timing)
+            self.db.create_header(
+                max_key_len="uint8", use_hash="bool", verify_keys="bool")
+            if verify_keys:
+                # the 64-bit hash is compared first, then the UTF-8 key
+                self.data = self.db.create_dataset(
+                    "data", key=f"S{max_key_len}", fingerprint="uint64",
+                    value=dtype)
+            elif use_hash:
                 self.data = self.db.create_dataset(
                     "data", key="uint64", value=dtype)
             else:
@@ -442,43 +1215,90 @@ class Dict:
                     self.data, "key",
                     cache_len=cache_len,
                     p_init=p_init,
-                    probe_factor=probe_factor))
+                    probe_factor=probe_factor,
+                    prehashed=use_hash and not verify_keys,
+                    migrate_buckets=migrate_buckets,
+                    fingerprint="fingerprint" if verify_keys else None))
+            self._create_datastructures()
             self.db.compile()
 
             # initialize values
             self.db.header["max_key_len"] = max_key_len
             self.db.header["use_hash"] = use_hash
+            self.db.header["verify_keys"] = verify_keys
         else:
             self.db = DB(filename, flag=flag,
                          blob_compression=blob_compression,
-                         blob_protocol=blob_protocol)
+                         blob_protocol=blob_protocol,
+                         io=io,
+                         durability=durability,
+                         wal=wal,
+                         cache_size=cache_size,
+                         cache_policy=cache_policy,
+                         threadsafe=threadsafe,
+                         shared=shared,
+                         timing=timing)
             self.data = self.db["data"]
             self.table = self.db["table"]
+            self._load_datastructures()
             max_key_len = self.db.header["max_key_len"]
             use_hash = self.db.header["use_hash"]
+            verify_keys = bool(self.db.header["verify_keys"])
 
         self.max_key_len = max_key_len
         self.use_hash = use_hash
+        self.verify_keys = verify_keys
         self.lru_cache = lru_cache
         if lru_cache > 0:
             from lru import LRU
             self.lru = LRU(lru_cache)
 
+    def _create_datastructures(self):
+        # datasets and datastructures of subclasses, created with the file
+        pass
+
+    def _load_datastructures(self):
+        pass
+
     def _hash(self, key, seed=0):
-        import mmh3
+        # 64-bit fingerprints
         if not isinstance(key, str):
             key = str(key)
-        return mmh3.hash(key, seed=seed, signed=False)
+        return mmh3.hash64(key, seed=seed, signed=False)[0]
+
+    def _get_table_key(self, key):
+        # key as stored in the table, None for keys that cannot be stored:
+        # too long, or ending with NUL bytes that the S or U field would
+        # strip
+        if self.verify_keys:
+            if not isinstance(key, str):
+                key = str(key)
+            key = key.encode()
+            if len(key) > self.max_key_len or key.endswith(b"\0"):
+                return None
+            return key
+        if self.use_hash:
+            return self._hash(key)
+        text = key if isinstance(key, str) else str(key)
+        if len(text) > self.max_key_len or text.endswith("\0"):
+            return None
+        return key
+
+    def _get_table_keys(self, keys):
+        table_keys = [self._get_table_key(key) for key in keys]
+        if not self.use_hash or self.verify_keys:
+            if any(key is None for key in table_keys):
+                unit = "bytes" if self.verify_keys else "characters"
+                raise ValueError(
+                    f"Keys are limited to {self.max_key_len} {unit} and "
+                    "cannot end with a NUL character")
+        return table_keys
 
     def __setitem__(self, key, value):
+        table_key = self._get_table_keys([key])[0]
         if self.lru_cache > 0:
             self.lru[key] = value
-
-        if self.use_hash:
-            key_hash = self._hash(key)
-            self.table[key_hash] = {"value": value}
-        else:
-            self.table[key] = {"value": value}
+        self.table[table_key] = {"value": value}
 
     def __getitem__(self, key):
         if self.lru_cache > 0:
@@ -486,13 +1306,136 @@ class Dict:
             if val is not None:
                 return val
 
-        if self.use_hash:
-            key_hash = self._hash(key)
-            return self.table[key_hash]["value"]
-        else:
-            return self.table[key]["value"]
+        table_key = self._get_table_key(key)
+        if table_key is None:
+            raise KeyError(key)
+        return self.table[table_key]["value"]
 
     def __delitem__(self, key):
-        if self.use_hash:
-            key = self._hash(key)
-        del self.table[key]
+        if self.lru_cache > 0 and key in self.lru:
+            del self.lru[key]
+        table_key = self._get_table_key(key)
+        if table_key is None:
+            raise KeyError(key)
+        del self.table[table_key]
+
+    def get_many(self, keys, default=None):
+        keys = list(keys)
+        res = [default] * len(keys)
+
+        # serve what can be from the LRU cache and look up the rest at once
+        missing = []
+        for i, key in enumerate(keys):
+            if self.lru_cache > 0:
+                val = self.lru.get(key)
+                if val is not None:
+                    res[i] = val
+                    continue
+            missing.append(i)
+        if len(missing) == 0:
+            return res
+
+        # keys too long to be stored are missing
+        table_keys = [self._get_table_key(keys[i]) for i in missing]
+        if not self.use_hash or self.verify_keys:
+            missing = [i for i, key in zip(missing, table_keys)
+                       if key is not None]
+            table_keys = [key for key in table_keys if key is not None]
+        values = self.table.lookup_many(
+            table_keys, default=default, field="value")
+        for i, value in zip(missing, values):
+            res[i] = value
+        return res
+
+    def set_many(self, keys, values):
+        keys = list(keys)
+        if not isinstance(values, ndarray):
+            values = list(values)
+        if len(keys) != len(values):
+            raise ValueError("Keys and values must be of the same length")
+        table_keys = self._get_table_keys(keys)
+
+        if self.lru_cache > 0:
+            for key, value in zip(keys, values):
+                if key in self.lru:
+                    self.lru[key] = value
+
+        self.table.insert_many(table_keys, {"value": values})
+
+    def update(self, items):
+        if hasattr(items, "keys"):
+            items = items.items()
+        items = list(items)
+        if len(items) == 0:
+            return
+        keys, values = zip(*items)
+        self.set_many(keys, values)
+
+    def vacuum(self):
+        """
+        Rewrites the file without deleted keys and overwritten values, see
+        DB.compact, and returns the number of bytes reclaimed.
+        """
+        return self.db.compact()
+
+    def stats(self):
+        """
+        Returns the stats of the database, see DB.stats, with those of the
+        LRU cache of values.
+        """
+        stats = self.db.stats()
+        if self.lru_cache > 0:
+            stats["lru"] = _get_lru_stats(self.lru)
+        return stats
+
+    def stats_prometheus(self, prefix="loom"):
+        return to_prometheus(self.stats(), prefix, {"file": self.db.filename})
+
+    def _scan(self, chunk_rows):
+        for rows in self.table.scan(chunk_rows=chunk_rows):
+            keys = rows["key"].tolist()
+            if self.verify_keys:
+                keys = [key.decode() for key in keys]
+            yield keys, rows
+
+    def keys(self, chunk_rows=2**16):
+        """
+        Keys are yielded as stored, that is hashed when use_hash is set,
+        and as strings when verify_keys is set.
+        """
+        for keys, _ in self._scan(chunk_rows):
+            yield from keys
+
+    def values(self, chunk_rows=2**16):
+        for _, rows in self._scan(chunk_rows):
+            yield from self.data._parse_values_many(rows, "value")
+
+    def items(self, chunk_rows=2**16):
+        """
+        Keys are yielded as stored, that is hashed when use_hash is set,
+        and as strings when verify_keys is set.
+        """
+        for keys, rows in self._scan(chunk_rows):
+            yield from zip(keys, self.data._parse_values_many(rows, "value"))
+
+    def __iter__(self):
+        return self.keys()
+
+    def map_reduce(self, mapper, reducer=None, workers=None,
+                   chunk_rows=2**16):
+        """
+        (function) mapper: called in worker processes with the keys and
+                           values of a chunk of rows, keys being stored as
+                           hashes when use_hash is set, or as UTF-8 bytes
+                           when verify_keys is set
+        (function) reducer: combines two mapper results, the list of mapper
+                            results is returned when not given
+        (int) workers: number of worker processes, os.cpu_count() if None
+        (int) chunk_rows: number of table slots handled per task
+        """
+        from functools import partial
+
+        from .datastructure.hashtable import _map_items
+        return self.table.parallel_scan(
+            partial(_map_items, mapper), workers=workers,
+            chunk_rows=chunk_rows, reducer=reducer, batch=False)
@@ -1,5 +1,5 @@
 from numpy import (array, dtype, frombuffer, int8, int32, int64, str_, uint32,
-                   uint64)
+                   uint64, zeros)
 
 from .exception import NotCompiledError
 
@@ -79,6 +79,43 @@ class Dataset:
         res = tuple(data.get(key, 0) for key in self._field)
         return array(res, dtype=self._dtypes)
 
+    def _get_prefixed_dtype(self):
+        return dtype([("prefix", PREFIX_DTYPE)] + self._dtypes)
+
+    def _get_record_dtype(self):
+        # dtype viewing the fields of a row while skipping its prefix
+        names = list(self._field)
+        return dtype({
+            "names": names,
+            "formats": [self._field[key][3] for key in names],
+            "offsets": [self._field[key][2] for key in names],
+            "itemsize": self._len})
+
+    def _to_numpy_many(self, data, n):
+        # rows with prefix built column by column from a dict of sequences
+        rows = zeros(n, dtype=[("prefix", PREFIX_DTYPE)] + self._dtypes)
+        rows["prefix"] = self._identifier
+        for key, values in data.items():
+            if key in self._blob_fields:
+                rows[key]["blob"] = [self._db_append_blob(v) for v in values]
+            else:
+                rows[key] = values
+        return rows
+
+    def _copy_rows(self, rows, db):
+        # rows of the same dataset in another database db, with prefix, and
+        # with the blobs they reference appended again to this database
+        res = zeros(len(rows), dtype=self._get_prefixed_dtype())
+        res["prefix"] = self._identifier
+        for key in self._field:
+            res[key] = rows[key]
+        for key in self._blob_fields:
+            addresses = res[key]["blob"]
+            for i in addresses.nonzero()[0].tolist():
+                addresses[i] = self._db_append(
+                    db._get_blob_bytes(int(addresses[i])))
+        return res
+
     def _to_bytes(self, data):
         if self._has_blob:
             # self.parse_blob(data)
@@ -87,7 +124,9 @@ class Dataset:
         return self._prefix + arr.tobytes()
 
     def _parse(self, res):
-        res = frombuffer(res, dtype=self._dtypes)[0]
+        return self._parse_record(frombuffer(res, dtype=self._dtypes)[0])
+
+    def _parse_record(self, res):
         if not self._has_blob:
             return dict(zip(self._field, res))
 
@@ -100,41 +139,34 @@ class Dataset:
             res[field] = self._db_get_blob(blob_id)
         return res
 
+    def _parse_many(self, rows):
+        # rows is a structured array with prefix, all rows being valid
+        rows = rows[list(self._field)]
+        return [self._parse_record(r) for r in rows]
+
+    def _parse_values_many(self, rows, key):
+        values = rows[key]
+        if key not in self._blob_fields:
+            return list(values)
+        return [self._db_get_blob(blob_id) if blob_id != 0 else None
+                for blob_id in values["blob"].tolist()]
+
     def _parse_with_prefix(self, res):
-        _dtypes = [("prefix", PREFIX_DTYPE)] + self._dtypes
-        res = frombuffer(res, dtype=_dtypes)
-
-        f = self._field_list
-        id_ = self._identifier
-        data = []
-        for r in res:
-            tmp = {}
-            for i, field in enumerate(f):
-                if i != 0:
-                    tmp[field] = r[i]
-                else:
-                    if r[0] == id_:
-                        continue
-                    else:
-                        tmp = None
-                        break
-            data.append(tmp)
-        return data
+        rows, valid = self._parse_raw(res)
+        fields = list(self._field)
+        return [dict(zip(fields, r)) if is_valid else None
+                for r, is_valid in zip(rows, valid.tolist())]
 
     def _parse_values(self, res, key):
-        _dtypes = [("prefix", PREFIX_DTYPE)] + self._dtypes
-        res = frombuffer(res, dtype=_dtypes)
-
-        index, _, _, _ = self._field[key]
-        f = self._field_list
-        id_ = self._identifier
-        data = []
-        for r in res:
-            if r[0] == id_:
-                data.append(r[index])
-            else:
-                data.append(None)
-        return data
+        rows, valid = self._parse_raw(res)
+        return [value if is_valid else None
+                for value, is_valid in zip(rows[key], valid.tolist())]
+
+    def _parse_raw(self, res):
+        # structured view over the rows and mask of the rows holding data
+        valid = frombuffer(res, dtype=self._get_prefixed_dtype())["prefix"]
+        valid = valid == self._identifier
+        return frombuffer(res, dtype=self._get_record_dtype()), valid
 
     # -------------------------------------------------------------------------
     # overloading functions
@@ -156,7 +188,7 @@ class Dataset:
 
     def _set_field_no_index(self, key, value):
         _, _, align, dt = self._field[key]
-        data = array(value, dtype=dt)
+        data = array(value, dtype=dt).tobytes()
         self._write_at(self._offset + align, data)
 
     def _get_field_no_index(self, key):
@@ -178,24 +210,35 @@ class Dataset:
     def append(self, **data):
         return self._db_append(self._to_bytes(data))
 
-    def get(self, block_index, row_index=0):
+    def get(self, block_index, row_index=0, raw=False):
+        """
+        (bool) raw: return the row as a numpy record viewing the read buffer
+                    instead of a dict, blob fields holding their addresses
+        """
         index = self._get_index_from(block_index, row_index)
-        data_bytes = self._read_at(index, 1)
+        data_bytes = self._read_at(index, self._len)
 
-        identifier = frombuffer(data_bytes, dtype="int8")[0]
+        identifier = frombuffer(data_bytes, dtype="int8", count=1)[0]
         if identifier != self._identifier:
             raise KeyError
-        data_bytes = self._read_at(index + self._prefix_size,
-                                   self._len - self._prefix_size)
-        return self._parse(data_bytes)
-
-    def get_slice(self, block_index, s):
+        if raw:
+            return frombuffer(data_bytes, dtype=self._get_record_dtype())[0]
+        return self._parse(memoryview(data_bytes)[self._prefix_size:])
+
+    def get_slice(self, block_index, s, raw=False):
+        """
+        (bool) raw: return a structured array viewing the read buffer and a
+                    boolean mask of the rows holding data, instead of a list
+                    of dicts with None for empty rows
+        """
         start = s.start or 0
         stop = s.stop
         length = stop - start
         index = self._get_index_from(block_index, start)
         data_bytes = self._read_at(index,
                                    self._len * length)
+        if raw:
+            return self._parse_raw(data_bytes)
         return self._parse_with_prefix(data_bytes)
 
     def get_slice_as_bytes(self, block_index, s):
@@ -207,13 +250,24 @@ class Dataset:
                                    self._len * length)
         return data_bytes
 
-    def get_slice_values(self, block_index, s, field):
+    def set_slice_as_bytes(self, block_index, start, data_bytes):
+        index = self._get_index_from(block_index, start)
+        self._write_at(index, data_bytes)
+
+    def get_slice_values(self, block_index, s, field, raw=False):
+        """
+        (bool) raw: return an array viewing the field in the read buffer and
+                    a boolean mask of the rows holding data
+        """
         start = s.start or 0
         stop = s.stop
         length = stop - start
         index = self._get_index_from(block_index, start)
         data_bytes = self._read_at(index,
                                    self._len * length)
+        if raw:
+            rows, valid = self._parse_raw(data_bytes)
+            return rows[field], valid
         return self._parse_values(data_bytes, field)
 
     def get_value(self, block_index, row_index, key):
@@ -457,6 +511,11 @@ class Array(Dataset):
         res = frombuffer(data_bytes, dtype=self._dtype)
         return res
 
+    def set_values(self, block_index, start, values):
+        index = int(block_index + self._dt_size * start + self._prefix_size)
+        data = array(values, dtype=self._dtype).tobytes()
+        self._write_at(index, data)
+
     def __getitem__(self, args):
         block_index, position = args
         if isinstance(position, int):
@@ -506,7 +565,7 @@ class BoolArray(Dataset):
     def get_value(self, block_index, index):
         index = int(block_index + index + self._prefix_size)
         data_bytes = self._read_at(index, 1)
-        return self._byte_to_bool[data_bytes]
+        return self._byte_to_bool[bytes(data_bytes)]
 
     def get_values(self, block_index, start, end):
         index = int(block_index + start + self._prefix_size)
@@ -1,2 +1,3 @@
 from .hashtable import Hashmap
 from .array import List
+from .ivf import IVF
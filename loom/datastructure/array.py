@@ -1,6 +1,9 @@
 from numpy import dtype
 import numpy as np
-from .base import DataStructure
+from .base import DataStructure, _get_runs
+
+MAX_ROW_GAP = 64
+COPY_CHUNK_ROWS = 2**16
 
 
 class List(DataStructure):
@@ -29,22 +32,30 @@ class List(DataStructure):
     # initialization
     # -------------------------------------------------------------------------
 
+    def _get_header_fields(self):
+        return {
+            f"{self._addr_name}": "uint64",
+            f"{self._index_name}": "uint64",
+        }
+
     def _compile(self, db):
         db._header_fields[self._addr_name] = dtype("uint64")
         db._header_fields[self._index_name] = dtype("uint64")
         self._tables_pos = db.create_array(
             self._tables_id_name, "uint64")
 
+    def _get_dataset_names(self):
+        return [self.dataset.name, self._tables_id_name]
+
     def _load(self):
-        self._tables_addr = self._db.header[self._addr_name]
-        self._index = self._db.header[self._index_name]
+        self._tables_addr = self._db._get_header(self._addr_name)
         self._tables_pos = self._db[self._tables_id_name]
 
         # if not yet initialized
         if self._tables_addr == 0:
             self._tables_addr = self._tables_pos.new_block(64)
-            self._db.header[self._addr_name] = self._tables_addr
-            self._db.header[self._index_name] = 0
+            self._db._set_header(self._addr_name, self._tables_addr)
+            self._db._set_header(self._index_name, 0)
 
             table_id = self.dataset.new_block(self.start_size)
             self._tables_pos.set_value(self._tables_addr, 0, table_id)
@@ -58,10 +69,54 @@ class List(DataStructure):
     def _save_tables_id(self, index, table_id):
         self._tables_pos.set_value(self._tables_addr, index, table_id)
 
+    def _get_table_id(self, table_number):
+        # tables are allocated the first time a row is written in them
+        table_id = self.tables_id[table_number]
+        if table_id == 0:
+            size = (self._table_sizes[table_number] -
+                    self._table_sizes[table_number - 1])
+            table_id = self.dataset.new_block(size)
+            self._save_tables_id(table_number, table_id)
+            self._load_tables_id()
+        return table_id
+
+    def _get_table_bounds(self, table_number):
+        # first and last + 1 positions held by a table
+        if table_number == 0:
+            return 0, self._table_sizes[0] + 1
+        return (self._table_sizes[table_number - 1] + 1,
+                self._table_sizes[table_number] + 1)
+
+    def _get_spans(self, start, stop):
+        # (table number, start, stop) row spans of each table in start:stop
+        spans = []
+        table_number = int(np.searchsorted(self._table_sizes, start))
+        while start < stop:
+            table_start, table_end = self._get_table_bounds(table_number)
+            end = min(stop, table_end)
+            spans.append(
+                (table_number, start - table_start, end - table_start))
+            start = end
+            table_number += 1
+        return spans
+
+    def _get_chunks(self, start, stop, chunk_rows):
+        # (table id, start, stop, position) slices of at most chunk_rows
+        # rows covering the positions start:stop
+        for table_number, a, b in self._get_spans(start, stop):
+            table_start, _ = self._get_table_bounds(table_number)
+            for c in range(a, b, chunk_rows):
+                yield (self.tables_id[table_number], c,
+                       min(c + chunk_rows, b), table_start + c)
+
     def _load_tables_id(self):
         self.tables_id = list(
             self._tables_pos.get_values(self._tables_addr, 0, 64))
 
+    def _refresh(self):
+        # tables allocated by the writer process
+        self._load_tables_id()
+
     # -------------------------------------------------------------------------
     # public functions
     # -------------------------------------------------------------------------
@@ -70,68 +125,234 @@ class List(DataStructure):
         self.insert(position, value)
 
     def insert(self, position, value):
-        index = self._db.header[self._index_name]
-        if position >= index:
-            raise IndexError("list index out of range")
-
-        table_number = np.searchsorted(self._table_sizes, position)
-        if table_number != 0:
-            table_index = int(
-                position - self._table_sizes[table_number - 1] - 1)
-        else:
-            table_index = position
+        position = self._check_position(position)
+        table_number = int(np.searchsorted(self._table_sizes, position))
+        table_start, _ = self._get_table_bounds(table_number)
         table_id = self.tables_id[table_number]
-        return self.dataset.set(table_id, table_index, value)
+        self._db.begin_transaction()
+        try:
+            return self.dataset.set(table_id, int(position - table_start),
+                                    value)
+        finally:
+            self._db.end_transaction()
 
     def append(self, value):
-        index = self._db.header[self._index_name]
-        table_number = np.searchsorted(self._table_sizes, index)
-        table_size = self._table_sizes[table_number]
-        if table_size == index:
-            new_table_size = self._table_sizes[table_number + 1] - table_size
-            table_id = self.dataset.new_block(new_table_size)
-            self._save_tables_id(table_number + 1, table_id)
-            self._load_tables_id()
+        # the row, the new table if any and the length are committed together
+        self._db.begin_transaction()
+        try:
+            self._append(value)
+        finally:
+            self._db.end_transaction()
 
-        if table_number != 0:
-            table_index = int(index - self._table_sizes[table_number - 1] - 1)
-        else:
-            table_index = index
-        table_id = self.tables_id[table_number]
-        self.dataset.set(table_id, table_index, value)
-        self._db.header[self._index_name] = index + 1
+    def _append(self, value):
+        index = self._db._get_header(self._index_name)
+        table_number = int(np.searchsorted(self._table_sizes, index))
+        table_start, _ = self._get_table_bounds(table_number)
+        table_id = self._get_table_id(table_number)
+        self.dataset.set(table_id, int(index - table_start), value)
+        self._db._set_header(self._index_name, index + 1)
+
+    def insert_many(self, positions, rows):
+        """
+        (sequence) positions: positions of the rows to overwrite, the last
+                              one wins on duplicates
+        (ndarray or list) rows: structured array with the dataset fields, or
+                                list of dicts sharing the same keys
+
+        Writes each run of consecutive positions of a table in a single call.
+        """
+        positions = self._check_positions(positions)
+        data, n = self._to_data(rows)
+        if n != len(positions):
+            raise ValueError("positions and rows differ in length")
+        if n == 0:
+            return
+
+        # last occurrence of each position, in position order
+        unique, last = np.unique(positions[::-1], return_index=True)
+        rows = self.dataset._to_numpy_many(data, n)[n - 1 - last]
+
+        self._db.begin_transaction()
+        try:
+            table_numbers = np.searchsorted(self._table_sizes, unique)
+            for table_number in np.unique(table_numbers).tolist():
+                selected = np.flatnonzero(table_numbers == table_number)
+                table_start, _ = self._get_table_bounds(table_number)
+                offsets = unique[selected] - table_start
+                table_rows = rows[selected]
+                position = 0
+                for start, stop in _get_runs(offsets):
+                    end = position + stop - start
+                    self.dataset.set_slice_as_bytes(
+                        self.tables_id[table_number], start,
+                        table_rows[position:end].tobytes())
+                    position = end
+        finally:
+            self._db.end_transaction()
+
+    def extend(self, rows):
+        """
+        (ndarray or list) rows: structured array with the dataset fields, or
+                                list of dicts sharing the same keys
+        """
+        data, n = self._to_data(rows)
+        if n == 0:
+            return
+
+        self._db.begin_transaction()
+        try:
+            self._extend_rows(self.dataset._to_numpy_many(data, n))
+        finally:
+            self._db.end_transaction()
+
+    def _to_data(self, rows):
+        # columns of the rows and their number
+        if isinstance(rows, np.ndarray):
+            return ({field: rows[field] for field in rows.dtype.names},
+                    len(rows))
+        rows = list(rows)
+        if len(rows) == 0:
+            return {}, 0
+        return ({field: [row[field] for row in rows] for field in rows[0]},
+                len(rows))
+
+    def _extend_rows(self, rows):
+        # rows fill the current table and the next ones, one write per table
+        index = int(self._db._get_header(self._index_name))
+        position = 0
+        for table_number, start, stop in self._get_spans(
+                index, index + len(rows)):
+            table_id = self._get_table_id(table_number)
+            end = position + stop - start
+            self.dataset.set_slice_as_bytes(
+                table_id, start, rows[position:end].tobytes())
+            position = end
+        self._db._set_header(self._index_name, index + len(rows))
 
     def lookup(self, position):
-        if isinstance(position, int):
+        if isinstance(position, (int, np.integer)):
             return self.lookup_single_value(position)
         elif isinstance(position, slice):
-            start = position.start
-            stop = position.stop
-            step = position.step
-            if start is None:
-                start = 0
-            if stop is None:
-                stop = self._db.header[self._index_name]
-            if step is None:
-                step = 1
-            return [self.lookup_single_value(i)
-                    for i in range(start, stop, step)]
+            start, stop, step = position.indices(len(self))
+            if step == 1:
+                return self.get_slice(start, stop)
+            return self.lookup_many(np.arange(start, stop, step))
         elif isinstance(position, (list, np.ndarray)):
-            return [self.lookup_single_value(i) for i in position]
+            return self.lookup_many(position)
 
-    def lookup_single_value(self, position):
-        index = self._db.header[self._index_name]
-        if position >= index:
+    def get_slice(self, start, stop, columnar=False, raw=False):
+        """
+        (int) start, stop: bounds of the rows to read
+        (bool) columnar: return a dict of columns instead of a structured
+                         array
+        (bool) raw: keep the blob addresses in the blob fields instead of
+                    the decoded values
+
+        Reads each underlying table span in a single call.
+        """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        chunks = []
+        for table_number, a, b in self._get_spans(start, stop):
+            chunks.append(self.dataset.get_slice_as_bytes(
+                self.tables_id[table_number], slice(a, b)))
+        data = chunks[0] if len(chunks) == 1 else b"".join(chunks)
+        rows = np.frombuffer(data, dtype=self.dataset._get_record_dtype())
+        return self._decode(rows, columnar, raw)
+
+    def lookup_many(self, positions, columnar=False, raw=False):
+        """
+        (sequence) positions: positions of the rows to read, negative ones
+                              counting from the end
+        (bool) columnar, raw: as in get_slice
+
+        Reads each run of nearby positions of a table in a single call.
+        """
+        positions = self._check_positions(positions)
+
+        # rows are read per table in runs of nearby positions
+        record_dtype = self.dataset._get_record_dtype()
+        rows = np.zeros(len(positions), dtype=record_dtype)
+        table_numbers = np.searchsorted(self._table_sizes, positions)
+        for table_number in np.unique(table_numbers).tolist():
+            selected = np.flatnonzero(table_numbers == table_number)
+            table_start, _ = self._get_table_bounds(table_number)
+            unique, inverse = np.unique(
+                positions[selected] - table_start, return_inverse=True)
+            chunks = []
+            offsets = []
+            for start, stop in _get_runs(unique, MAX_ROW_GAP):
+                chunks.append(np.frombuffer(self.dataset.get_slice_as_bytes(
+                    self.tables_id[table_number], slice(start, stop)),
+                    dtype=record_dtype))
+                offsets.append(np.arange(start, stop))
+            offsets = np.concatenate(offsets)
+            table_rows = np.concatenate(chunks)
+            rows[selected] = table_rows[
+                np.searchsorted(offsets, unique)][inverse]
+        return self._decode(rows, columnar, raw)
+
+    def _check_position(self, position):
+        # position as an int, negative ones counting from the end
+        length = len(self)
+        if position < 0:
+            position += length
+        if position < 0 or position >= length:
+            raise IndexError("list index out of range")
+        return int(position)
+
+    def _check_positions(self, positions):
+        # positions as an int64 array, negative ones counting from the end
+        positions = np.asarray(positions, dtype=np.int64)
+        length = len(self)
+        positions = np.where(positions < 0, positions + length, positions)
+        if len(positions) and (positions.min() < 0 or
+                               positions.max() >= length):
             raise IndexError("list index out of range")
+        return positions
+
+    def _copy_from(self, other):
+        # rows of other, the same list in another file, appended in order
+        length = len(other)
+        for start in range(0, length, COPY_CHUNK_ROWS):
+            rows = other.get_slice(
+                start, min(start + COPY_CHUNK_ROWS, length), raw=True)
+            self._extend_rows(self.dataset._copy_rows(rows, other._db))
+
+    def _decode(self, rows, columnar, raw):
+        # rows as returned by get_slice and lookup_many
+        blob_fields = self.dataset._blob_fields
+        if raw or not blob_fields:
+            if columnar:
+                return {field: rows[field] for field in self.dataset._field}
+            return rows
 
-        table_number = np.searchsorted(self._table_sizes, position)
-        if table_number != 0:
-            table_index = int(
-                position - self._table_sizes[table_number - 1] - 1)
-        else:
-            table_index = position
+        columns = {}
+        for field in self.dataset._field:
+            if field in blob_fields:
+                columns[field] = self.dataset._parse_values_many(rows, field)
+            else:
+                columns[field] = rows[field]
+        if columnar:
+            return columns
+        # blob fields hold the decoded values as objects
+        res = np.empty(len(rows), dtype=[
+            (field, object if field in blob_fields else dt)
+            for field, (_, _, _, dt) in self.dataset._field.items()])
+        for field, column in columns.items():
+            if field in blob_fields:
+                values = res[field]
+                for i, value in enumerate(column):
+                    values[i] = value
+            else:
+                res[field] = column
+        return res
+
+    def lookup_single_value(self, position):
+        position = self._check_position(position)
+        table_number = int(np.searchsorted(self._table_sizes, position))
+        table_start, _ = self._get_table_bounds(table_number)
         table_id = self.tables_id[table_number]
-        return self.dataset.get(table_id, table_index)
+        return self.dataset.get(table_id, int(position - table_start))
 
     def __len__(self):
-        return self._db.header[self._index_name]
+        return self._db._get_header(self._index_name)
@@ -1,4 +1,16 @@
 import mmh3
+import numpy as np
+
+
+def _get_runs(positions, max_gap=0):
+    # (start, stop) bounds of the runs of sorted positions, merging two runs
+    # when less than max_gap positions separate them
+    if len(positions) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(positions) > max_gap + 1) + 1
+    starts = positions[np.r_[0, breaks]]
+    stops = positions[np.r_[breaks - 1, len(positions) - 1]] + 1
+    return list(zip(starts.tolist(), stops.tolist()))
 
 
 class DataStructure:
@@ -12,6 +24,15 @@ class DataStructure:
     def _add_database_reference(self, db):
         self._db = db
 
+    def _refresh(self):
+        pass
+
+    def _get_stats(self):
+        return {}
+
+    def _get_dataset_names(self):
+        return []
+
     def _hash(self, key, seed=0):
         if not isinstance(key, str):
             key = str(key)
@@ -0,0 +1,87 @@
+import math
+
+import numpy as np
+
+# a block is one 64-byte cache line, all the bits of a key fall in it
+BLOCK_BYTES = 64
+BLOCK_WORDS = BLOCK_BYTES // 8
+GOLDEN = 0x9E3779B97F4A7C15
+MASK32 = 2**32 - 1
+MASK64 = 2**64 - 1
+
+
+def _get_bloom_size(n_items, fpr):
+    # number of blocks and of hash functions for n_items at the given
+    # false positive rate
+    n_bits = -n_items * math.log(fpr) / math.log(2)**2
+    n_blocks = max(int(math.ceil(n_bits / (8 * BLOCK_BYTES))), 1)
+    k = max(int(round(n_bits / n_items * math.log(2))), 1)
+    return n_blocks, k
+
+
+class BlockedBloomFilter:
+    def __init__(self, data, k, copy=True):
+        """
+        (ndarray) data: bits of the filter, a whole number of blocks
+        (int) k: number of bits set per key
+        (bool) copy: hold a copy of data, otherwise a read-only view of it
+
+        Keys are given as 64-bit hashes: the hash picks a block and the k
+        bits are derived from it by double hashing.
+        """
+        if copy:
+            data = np.array(data, dtype=np.uint8)
+        self.words = np.frombuffer(data, dtype=np.uint8).view(np.uint64)
+        self._bytes = memoryview(self.words).cast("B")
+        self.n_blocks = len(self.words) // BLOCK_WORDS
+        self.k = k
+
+    def _get_steps(self, bloom_hash):
+        # block, and start and step of the double hashing of the bits
+        mixed = (bloom_hash * GOLDEN) & MASK64
+        return bloom_hash % self.n_blocks, mixed >> 32, (mixed & MASK32) | 1
+
+    def __contains__(self, bloom_hash):
+        block, a, b = self._get_steps(bloom_hash)
+        start = block * BLOCK_BYTES
+        bits = int.from_bytes(
+            self._bytes[start:start + BLOCK_BYTES], "little")
+        for i in range(self.k):
+            if not bits >> ((a + i * b) & 511) & 1:
+                return False
+        return True
+
+    def add(self, bloom_hash):
+        # returns the block holding the bits of the key
+        block, a, b = self._get_steps(bloom_hash)
+        for i in range(self.k):
+            bit = (a + i * b) & 511
+            self.words[block * BLOCK_WORDS + (bit >> 6)] |= \
+                np.uint64(1 << (bit & 63))
+        return block
+
+    def _get_words_and_masks(self, bloom_hashes):
+        bloom_hashes = np.asarray(bloom_hashes, dtype=np.uint64)
+        mixed = bloom_hashes * np.uint64(GOLDEN)
+        a = mixed >> np.uint64(32)
+        b = (mixed & np.uint64(MASK32)) | np.uint64(1)
+        steps = np.arange(self.k, dtype=np.uint64)
+        bits = (a[:, None] + steps * b[:, None]) & np.uint64(511)
+        blocks = bloom_hashes % np.uint64(self.n_blocks)
+        words = (blocks[:, None] * np.uint64(BLOCK_WORDS) +
+                 (bits >> np.uint64(6)))
+        masks = np.uint64(1) << (bits & np.uint64(63))
+        return blocks, words.astype(np.int64), masks
+
+    def contains_many(self, bloom_hashes):
+        _, words, masks = self._get_words_and_masks(bloom_hashes)
+        return ((self.words[words] & masks) != 0).all(axis=1)
+
+    def add_many(self, bloom_hashes):
+        # returns the sorted blocks holding the bits of the keys
+        blocks, words, masks = self._get_words_and_masks(bloom_hashes)
+        np.bitwise_or.at(self.words, words.ravel(), masks.ravel())
+        return np.unique(blocks).astype(np.int64)
+
+    def get_bytes(self, start_block, stop_block):
+        return self._bytes[start_block * BLOCK_BYTES:stop_block * BLOCK_BYTES]
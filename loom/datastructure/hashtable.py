@@ -1,8 +1,45 @@
+import time
+
 import mmh3
+import numpy as np
 from numpy import dtype
 from numpy import max as np_max
 from numpy import nonzero
 
+from ..dataset import PREFIX_DTYPE
+from ..stats import Histogram, _get_lru_stats
+from .base import _get_runs
+from .bloom import BLOCK_BYTES, BlockedBloomFilter, _get_bloom_size
+
+BLOOM_BLOCK_GAP = 8
+MIGRATION_CHUNK_ROWS = 4096
+COMPACT_LOAD_FACTOR = .5
+GROWTH_LOAD_FACTOR = .5
+
+# database opened read-only by each parallel scan worker process
+_scan_db = None
+
+
+def _open_scan_db(filename, kwargs):
+    global _scan_db
+    from ..database import DB
+    _scan_db = DB(filename, flag="r", **kwargs)
+
+
+def _scan_range(fn, dataset_name, batch, task):
+    table_id, start, stop = task
+    dataset = _scan_db.datasets[dataset_name]
+    rows, valid = dataset.get_slice(table_id, slice(start, stop), raw=True)
+    rows = rows[valid]
+    if not batch:
+        rows = dataset._parse_many(rows)
+    return fn(rows)
+
+
+def _map_items(mapper, rows):
+    return mapper([row["key"] for row in rows],
+                  [row["value"] for row in rows])
+
 
 class BaseHashmap:
     def _get_header_fields(self):
@@ -15,6 +52,15 @@ class BaseHashmap:
     def _add_database_reference(self, db):
         self._db = db
 
+    def _refresh(self):
+        pass
+
+    def _get_stats(self):
+        return {}
+
+    def _get_dataset_names(self):
+        return []
+
     def _hash(self, key, seed=0):
         if not isinstance(key, str):
             key = str(key)
@@ -44,9 +90,31 @@ class Hashmap(BaseHashmap):
     def __init__(
         self, dataset, key,
         growth_factor=2, p_init=10, probe_factor=.5,
-        n_bloom_filters=10, bloom_seed=0, cache_len=100000
+        n_bloom_filters=10, bloom_seed=0, cache_len=100000, prehashed=False,
+        bloom_fpr=0.01, migrate_buckets=0, fingerprint=None
     ):
+        """
+        (int) n_bloom_filters: 0 disables the bloom filters
+        (float) bloom_fpr: false positive rate targeted by the blocked bloom
+                           filter of each table when it is full
+        (bool) prehashed: keys are uniformly distributed integers, such as
+                          fingerprints, and give table and bloom positions
+                          without being hashed again
+        (int) migrate_buckets: slots of the oldest table whose keys are moved
+                               to newer tables on each insert, until lookups
+                               only visit the newest table, 0 leaves the
+                               keys in place unless migrate is called
+        (str) fingerprint: uint64 field storing the 64-bit hash of each key,
+                           keys are only compared where fingerprints match,
+                           and are placed again without being hashed
+        """
         self.key = key
+        if prehashed and dataset._field[key][3].kind not in "ui":
+            raise ValueError("Prehashed keys must be integers")
+        if fingerprint is not None and (
+                prehashed or dataset._field[fingerprint][3] != "uint64"):
+            raise ValueError(
+                "Fingerprints are uint64 fields of keys not prehashed")
 
         # hashtable parametrization
         self.p_init = p_init
@@ -54,6 +122,10 @@ class Hashmap(BaseHashmap):
         self.growth_factor = growth_factor
         self.n_bloom_filters = n_bloom_filters
         self.bloom_seed = bloom_seed
+        self.prehashed = prehashed
+        self.bloom_fpr = bloom_fpr
+        self.migrate_buckets = migrate_buckets
+        self.fingerprint = fingerprint
 
         # cache management
         self.cache_len = cache_len
@@ -75,16 +147,49 @@ class Hashmap(BaseHashmap):
             f"{self._bloom_id_name}": "uint64",
         }
 
+    def _compile(self, db):
+        db._header_fields[self._block_id_name] = dtype("uint64")
+        db._header_fields[self._bloom_id_name] = dtype("uint64")
+        self._tables_pos = db.create_array(self.tables_id_name, "uint64")
+        self._bloom = db.create_array(self._bloom_filter_name, "uint8")
+
+    def _get_dataset_names(self):
+        return [self.dataset.name, self.tables_id_name,
+                self._bloom_filter_name]
+
     def _load(self):
+        # next slot of the table being migrated, rescanned from the start
+        # when the file is opened again, whether keys were placed behind it
+        # since the pass started, whether some were left for lack of room
+        # in the newer tables, and the tables left so until one is added
+        self._migration_position = 0
+        self._migration_restart = False
+        self._migration_left = False
+        self._kept_levels = frozenset()
+        # space of the tables dropped since the file was opened, given to
+        # the next table of the same size
+        self._free_tables = {}
+        # odd while tables are added, dropped or keys moved between them,
+        # lookups of other threads overlapping such a change are retried
+        self._version = 0
+        self._change_depth = 0
+
         # create LRU cache if needed
         if self.cache_len > 0:
             from lru import LRU
             self.cache = LRU(self.cache_len)
 
-        # create header and arrays
+        # counters kept since the file was opened
+        self._stats = dict.fromkeys((
+            "lookups", "lookup_misses", "inserts", "levels_visited",
+            "probes", "bloom_rejects", "bloom_false_positives",
+            "migrated_keys"), 0)
+        self._probe_lengths = Histogram()
+
+        # load header and arrays
         self._block_id = self._db.header[self._block_id_name]
-        self._tables_pos = self._db.create_array(self.tables_id_name, "uint64")
-        self._bloom = self._db.create_array(self._bloom_filter_name, "uint8")
+        self._tables_pos = self._db[self.tables_id_name]
+        self._bloom = self._db[self._bloom_filter_name]
 
         # if not yet initialized
         if self._block_id == 0:
@@ -98,25 +203,31 @@ class Hashmap(BaseHashmap):
             self._tables_pos.set_value(self._block_id, 0, table_id)
             self.p_last = self.p_init
             self._load_tables_id()
+            self._levels = [self.p_init]
 
             if self.n_bloom_filters > 0:
                 # create array of bloom filters positions
                 self._bloom_id = self._tables_pos.new_block(32)
                 self._db.header[self._bloom_id_name] = self._bloom_id
-                filter_id = self._bloom.new_block(
-                    capacity * self.n_bloom_filters)
+                filter_id = self._new_bloom_filter(self.p_init)
                 self._tables_pos.set_value(self._bloom_id, 0, filter_id)
                 self._load_bloom_filters()
-                self.find_lookup_position = self._find_lookup_position_filtered
         else:
             self._load_tables_id()
-            self.p_last = np_max(nonzero(self.tables_id)) + self.p_init
+            self._load_levels()
 
             if self.n_bloom_filters > 0:
                 self._bloom_id = self._db.header[self._bloom_id_name]
                 self._load_bloom_filters()
-                self.find_lookup_position = self._find_lookup_position_filtered
 
+        if self.n_bloom_filters > 0:
+            self._filters = {}
+            self._filter_ids = {}
+            self._load_filters()
+            self.find_lookup_position = self._find_lookup_position_blocked
+
+        self._row_dtype = dtype(
+            [("prefix", PREFIX_DTYPE)] + self.dataset._dtypes)
         self.get = self.dataset.get
         self.exists = self.dataset.exists
         self.status = self.dataset.status
@@ -133,10 +244,65 @@ class Hashmap(BaseHashmap):
         self.tables_id = list(
             self._tables_pos.get_values(self._block_id, 0, 32))
 
+    def _load_levels(self):
+        # levels holding a table, newest first, emptied ones are dropped
+        self.p_last = int(np_max(nonzero(self.tables_id))) + self.p_init
+        self._levels = [p for p in range(self.p_last, self.p_init - 1, -1)
+                        if self.tables_id[p - self.p_init] != 0]
+
     def _load_bloom_filters(self):
         self.bloom_filters = list(
             self._tables_pos.get_values(self._bloom_id, 0, 32))
 
+    def _load_filters(self):
+        # blocked bloom filters of every table, held in memory; readers of a
+        # shared file map them instead, so that the bits set by the writer
+        # are seen without reading the filters again on each refresh
+        mapped = self._db._generation_map is not None
+        filters = {}
+        filter_ids = {}
+        for p in self._levels:
+            filter_id = self.bloom_filters[p - self.p_init]
+            filter_ids[p] = filter_id
+            if mapped and self._filter_ids.get(p) == filter_id:
+                filters[p] = self._filters[p]
+                continue
+            n_blocks, k = _get_bloom_size(
+                self._get_capacity(p), self.bloom_fpr)
+            if mapped:
+                data = self._db._map_region(
+                    int(filter_id) + self._bloom._prefix_size,
+                    n_blocks * BLOCK_BYTES)
+                filters[p] = BlockedBloomFilter(data, k, copy=False)
+            else:
+                filters[p] = BlockedBloomFilter(self._bloom.get_values(
+                    filter_id, 0, n_blocks * BLOCK_BYTES), k)
+        self._filters = filters
+        self._filter_ids = filter_ids
+
+    def _get_stats(self):
+        stats = dict(self._stats)
+        stats["levels"] = len(self._levels)
+        stats["probe_length"] = self._probe_lengths.to_dict()
+        if self.cache_len > 0:
+            for key, value in _get_lru_stats(self.cache).items():
+                stats[f"cache_{key}"] = value
+        return stats
+
+    def _refresh(self):
+        # tables created and keys placed by the writer process
+        self._load_tables_id()
+        self._load_levels()
+        self._migration_position = 0
+        self._migration_restart = False
+        self._migration_left = False
+        self._kept_levels = frozenset()
+        if self.n_bloom_filters > 0:
+            self._load_bloom_filters()
+            self._load_filters()
+        if self.cache_len > 0:
+            self.cache.clear()
+
     # -------------------------------------------------------------------------
     # utilities
     # -------------------------------------------------------------------------
@@ -147,21 +313,212 @@ class Hashmap(BaseHashmap):
     def _get_capacity(self, p):
         return self.growth_factor**p
 
+    def _get_window(self, key_hash, p):
+        # rows of the probe window of key_hash in the pth table, read in one
+        # slice, or two when the window wraps around the end of the table
+        capacity = self._get_capacity(p)
+        bucket = key_hash % capacity
+        stop = bucket + min(len(self._get_range(p)), capacity)
+        table_id = self.tables_id[p - self.p_init]
+
+        data = self.dataset.get_slice_as_bytes(
+            table_id, slice(bucket, min(stop, capacity)))
+        if stop > capacity:
+            data = b"".join((data, self.dataset.get_slice_as_bytes(
+                table_id, slice(0, stop - capacity))))
+        return bucket, np.frombuffer(data, dtype=self._row_dtype)
+
+    def _get_windows(self, p, key_hashes):
+        # probe window positions in the pth table, one row per key hash
+        capacity = np.uint64(self._get_capacity(p))
+        offsets = np.arange(len(self._get_range(p)), dtype=np.uint64)
+        windows = (key_hashes[:, None] % capacity + offsets) % capacity
+        return windows.astype(np.int64)
+
+    def _load_rows(self, tables, p, positions):
+        # read the missing rows of the pth table in contiguous runs and
+        # merge them with the rows already held in memory for this table
+        row_dtype = self._row_dtype
+        if p not in tables:
+            tables[p] = [np.empty(0, dtype=np.int64),
+                         np.empty(0, dtype=row_dtype),
+                         np.empty(0, dtype=bool)]
+        loaded, rows, dirty = tables[p]
+
+        missing = np.setdiff1d(positions, loaded)
+        if len(missing) == 0:
+            return tables[p]
+
+        table_id = self.tables_id[p - self.p_init]
+        new_positions = [loaded]
+        chunks = []
+        for start, stop in _get_runs(missing, len(self._get_range(p))):
+            chunks.append(self.dataset.get_slice_as_bytes(
+                table_id, slice(start, stop)))
+            new_positions.append(np.arange(start, stop))
+
+        # rows already in memory come first so that np.unique keeps them
+        loaded, index = np.unique(
+            np.concatenate(new_positions), return_index=True)
+        all_rows = np.concatenate(
+            [rows, np.frombuffer(b"".join(chunks), dtype=row_dtype)])
+        dirty = np.concatenate(
+            [dirty, np.zeros(len(all_rows) - len(dirty), dtype=bool)])
+        rows, dirty = all_rows[index], dirty[index]
+        tables[p] = [loaded, rows, dirty]
+        return tables[p]
+
+    def _write_rows(self, tables):
+        # write back modified rows, one write per contiguous run
+        for p, (positions, rows, dirty) in tables.items():
+            table_id = self.tables_id[p - self.p_init]
+            for start, stop in _get_runs(positions):
+                i, j = np.searchsorted(positions, [start, stop])
+                modified = np.flatnonzero(dirty[i:j])
+                if len(modified) == 0:
+                    continue
+                a, b = i + modified[0], i + modified[-1] + 1
+                self.dataset.set_slice_as_bytes(
+                    table_id, int(positions[a]), rows[a:b].tobytes())
+
+    def _hash_key(self, key):
+        # table and bloom hashes of a key, the two halves of a single 128-bit
+        # hash, or the high bits of a prehashed key or of a fingerprint for
+        # the bloom filter
+        if self.prehashed:
+            key = int(key)
+            return key, key >> 32
+        if self.fingerprint is not None:
+            key_hash = mmh3.hash64(key, seed=self.bloom_seed, signed=False)[0]
+            return key_hash, key_hash >> 32
+        if not isinstance(key, str):
+            key = str(key)
+        return mmh3.hash64(key, seed=self.bloom_seed, signed=False)
+
+    def _hash_many(self, keys):
+        if self.prehashed:
+            key_hashes = keys.astype(np.uint64)
+            return key_hashes, key_hashes >> np.uint64(32)
+        if self.fingerprint is not None:
+            key_hashes = np.array(
+                [mmh3.hash64(key, seed=self.bloom_seed, signed=False)[0]
+                 for key in keys.tolist()], dtype=np.uint64)
+            return key_hashes, key_hashes >> np.uint64(32)
+        hashes = np.array(
+            [self._hash_key(key) for key in keys.tolist()],
+            dtype=np.uint64).reshape(-1, 2)
+        return hashes[:, 0], hashes[:, 1]
+
+    def _hash_rows(self, rows):
+        # stored fingerprints spare hashing the keys of rows placed again
+        if self.fingerprint is not None:
+            key_hashes = rows[self.fingerprint]
+            return key_hashes, key_hashes >> np.uint64(32)
+        return self._hash_many(rows[self.key])
+
+    def _match_window(self, rows, key, key_hash):
+        # slots of a window holding the key, where fingerprints are used
+        # the keys are only compared in the slots whose fingerprint matches
+        if self.fingerprint is None:
+            return (rows[self.key] == key).tolist()
+        match = rows[self.fingerprint] == key_hash
+        for i in np.flatnonzero(match).tolist():
+            match[i] = rows[self.key][i] == key
+        return match.tolist()
+
+    def _match_windows(self, rows, keys, key_hashes):
+        if self.fingerprint is None:
+            return rows[self.key] == keys[:, None]
+        match = rows[self.fingerprint] == key_hashes[:, None]
+        i, j = np.nonzero(match)
+        match[i, j] = rows[self.key][i, j] == keys[i]
+        return match
+
     # -------------------------------------------------------------------------
     # positioning functions
     # -------------------------------------------------------------------------
 
-    def _find_insert_or_lookup_position(self, key, key_hash):
+    def _find_lookup_positions_many(self, keys, key_hashes, bloom_hashes,
+                                    tables):
+        # level and position of each key, -1 as level for missing keys
+        ident = self.dataset._identifier
+        found_p = np.full(len(keys), -1)
+        found_pos = np.zeros(len(keys), dtype=np.int64)
+        stats = self._stats
+        for p in self._levels:
+            todo = np.flatnonzero(found_p < 0)
+            if self.n_bloom_filters > 0 and len(todo) > 0:
+                passed = self._filters[p].contains_many(bloom_hashes[todo])
+                stats["bloom_rejects"] += len(todo) - int(passed.sum())
+                todo = todo[passed]
+            if len(todo) == 0:
+                continue
+
+            windows = self._get_windows(p, key_hashes[todo])
+            positions, rows, _ = self._load_rows(
+                tables, p, np.unique(windows))
+            idx = np.searchsorted(positions, windows)
+            prefix = rows["prefix"][idx]
+            match = (prefix == ident) & self._match_windows(
+                rows[idx], keys[todo], key_hashes[todo])
+            empty = (prefix != ident) & (prefix != -ident)
+
+            # a key is found if it comes before the first empty slot
+            first_match = np.argmax(match, axis=1)
+            first_empty = np.where(
+                empty.any(axis=1), np.argmax(empty, axis=1), windows.shape[1])
+            hit = match.any(axis=1) & (first_match < first_empty)
+            probes = np.where(hit, first_match + 1,
+                              np.minimum(first_empty + 1, windows.shape[1]))
+            stats["levels_visited"] += len(todo)
+            stats["probes"] += int(probes.sum())
+            self._probe_lengths.add_many(probes)
+            if self.n_bloom_filters > 0:
+                stats["bloom_false_positives"] += int((~hit).sum())
+            found_p[todo[hit]] = p
+            found_pos[todo[hit]] = windows[hit, first_match[hit]]
+        return found_p, found_pos
+
+    def _place_many_in_table(self, p, pending, key_hashes, rows_new, tables,
+                             placed_p, placed_pos):
+        # every pending key claims the first free slot of its window; when
+        # several keys claim the same slot the earliest one gets it and the
+        # others try again on the updated table
+        ident = self.dataset._identifier
+        windows = self._get_windows(p, key_hashes[pending])
+        positions, rows, dirty = self._load_rows(
+            tables, p, np.unique(windows))
+        idx = np.searchsorted(positions, windows)
+        while len(pending) > 0:
+            free = rows["prefix"][idx] != ident
+            candidates = np.flatnonzero(free.any(axis=1))
+            if len(candidates) == 0:
+                break
+            first = idx[candidates, np.argmax(free[candidates], axis=1)]
+            slots, winners = np.unique(first, return_index=True)
+            winners = candidates[winners]
+
+            rows[slots] = rows_new[pending[winners]]
+            dirty[slots] = True
+            placed_p[pending[winners]] = p
+            placed_pos[pending[winners]] = positions[slots]
+
+            keep = np.ones(len(pending), dtype=bool)
+            keep[winners] = False
+            pending, idx = pending[keep], idx[keep]
+        return pending
+
+    def _find_insert_or_lookup_position(self, key, key_hash, bloom_hash):
         try:
-            p, position = self.find_lookup_position(key, key_hash)
+            p, position = self.find_lookup_position(key, key_hash, bloom_hash)
             return p, position, False
         except KeyError:
             p, position = self._find_insert_position(key, key_hash)
             return p, position, True
 
-    def _find_insert_or_lookup_index(self, key, key_hash):
+    def _find_insert_or_lookup_index(self, key, key_hash, bloom_hash):
         try:
-            p, position = self.find_lookup_position(key, key_hash)
+            p, position = self.find_lookup_position(key, key_hash, bloom_hash)
             table_id = self.tables_id[p - self.p_init]
             return table_id, position, False
         except KeyError:
@@ -169,92 +526,93 @@ class Hashmap(BaseHashmap):
             table_id = self.tables_id[p - self.p_init]
             return table_id, position, True
 
+    def _get_migration_level(self):
+        # oldest table but the newest whose keys may fit in newer ones
+        for p in reversed(self._levels[1:]):
+            if p not in self._kept_levels:
+                return p
+        return None
+
+    def _get_migrated_level(self):
+        # table whose keys are being moved to the newer ones
+        if self.migrate_buckets > 0 or self._migration_position > 0:
+            return self._get_migration_level()
+        return None
+
+    def _placed_in_migrated_level(self, p, positions):
+        # keys placed behind the migration position are moved by another
+        # pass over the table before it is dropped
+        if p == self._get_migrated_level() and \
+                np.any(np.asarray(positions) < self._migration_position):
+            self._migration_restart = True
+
     def _find_insert_position(self, key, key_hash):
-        for p in range(self.p_last, self.p_init - 1, -1):
+        # the table being migrated only takes the keys that fit in no newer
+        # one, being tried after them
+        for p in self._levels:
             try:
                 p, position = self._find_insert_position_in_table(
                     key, key_hash, p)
+                self._placed_in_migrated_level(p, position)
                 return p, position
             except KeyError:
                 continue
 
-        self._create_new_hashtable()
-        p, position = self._find_insert_position_in_table(
-            key, key_hash, self.p_last)
+        p = self._add_table()
+        p, position = self._find_insert_position_in_table(key, key_hash, p)
         return p, position
 
     def _find_insert_position_in_table(self, key, key_hash, p):
-        key_name = self.key
-
-        capacity = self._get_capacity(p)
-        bucket = key_hash % capacity
-        table_id = self.tables_id[p - self.p_init]
-        print(p, self._get_range(p), table_id, bucket)
-        print(self.status)
-
-        limit = int(round(p * self.probe_factor * self.growth_factor))
-        data = self.dataset.get_slice_as_bytes(
-            table_id, slice(bucket, bucket+limit))
-        for i in self._get_range(p):
-            position = (bucket + i) % capacity
-            status = self.status(table_id, position)
-            if status == 1:
-                key_current = self.get_value(
-                    table_id, position, key_name)
-                if key_current != key:
-                    continue
-                return p, position
-            else:
-                return p, position
+        bucket, rows = self._get_window(key_hash, p)
+
+        # first slot that is not taken by another key
+        ident = self.dataset._identifier
+        match = self._match_window(rows, key, key_hash)
+        for i, status in enumerate(rows["prefix"].tolist()):
+            if status != ident or match[i]:
+                return p, (bucket + i) % self._get_capacity(p)
         raise KeyError
 
-    def _find_insert_position_in_table(self, key, key_hash, p):
-        key_name = self.key
-
-        capacity = self._get_capacity(p)
-        bucket = key_hash % capacity
-        table_id = self.tables_id[p - self.p_init]
-        for i in self._get_range(p):
-            position = (bucket + i) % capacity
-            status = self.status(table_id, position)
-            if status == 1:
-                key_current = self.get_value(
-                    table_id, position, key_name)
-                if key_current != key:
-                    continue
-                return p, position
-            else:
-                return p, position
-        raise KeyError
+    def _get_cached_position(self, key):
+        # positions behind the migration position, or in dropped tables,
+        # are outdated since their keys were moved
+        p, position = self.cache.get(key, (None, None))
+        if p is None:
+            return p, position
+        if p not in self._levels or (
+                p == self._get_migration_level() and
+                position < self._migration_position):
+            del self.cache[key]
+            return None, None
+        return p, position
 
-    def _find_lookup_position_filtered(self, key, key_hash):
+    def _find_lookup_position_blocked(self, key, key_hash, bloom_hash):
         if self.cache_len > 0:
-            p, position = self.cache.get(key, (None, None))
+            p, position = self._get_cached_position(key)
             if p is not None:
                 return p, position
 
-        bloom_hash = self._hash(key, self.bloom_seed)
-        for p in range(self.p_last, self.p_init - 1, -1):
-            bloom_p = self.bloom_filters[p - self.p_init]
-            bloom_capacity = self._get_capacity(p) * self.n_bloom_filters
-            bucket = bloom_hash % bloom_capacity
-            if self._bloom.get_value(bloom_p, bucket) == 0:
+        # tables whose filter rejects the key cost no IO
+        filters = self._filters
+        for p in self._levels:
+            if bloom_hash not in filters[p]:
+                self._stats["bloom_rejects"] += 1
                 continue
             try:
                 p, position = self._find_lookup_position_in_table(
                     key, key_hash, p)
                 return p, position
             except KeyError:
-                pass
+                self._stats["bloom_false_positives"] += 1
         raise KeyError
 
-    def find_lookup_position(self, key, key_hash):
+    def find_lookup_position(self, key, key_hash, bloom_hash=None):
         if self.cache_len > 0:
-            p, position = self.cache.get(key, (None, None))
+            p, position = self._get_cached_position(key)
             if p is not None:
                 return p, position
 
-        for p in range(self.p_last, self.p_init - 1, -1):
+        for p in self._levels:
             try:
                 p, position = self._find_lookup_position_in_table(
                     key, key_hash, p)
@@ -264,94 +622,570 @@ class Hashmap(BaseHashmap):
         raise KeyError
 
     def _find_lookup_position_in_table(self, key, key_hash, p):
-        key_name = self.key
-
-        capacity = self._get_capacity(p)
-        bucket = key_hash % capacity
-        table_id = self.tables_id[p - self.p_init]
-        for i in self._get_range(p):
-            position = (bucket + i) % capacity
-            status = self.status(table_id, position)
-            if status == 1:
-                key_current = self.get_value(table_id, position, key_name)
-                if key_current != key:
-                    continue
-                return p, position
-            elif status == -1:
-                continue
-            else:
-                raise KeyError
-        raise KeyError
+        bucket, rows = self._get_window(key_hash, p)
+
+        # scan the window until the key or an empty slot is found,
+        # tombstones are skipped
+        ident = self.dataset._identifier
+        match = self._match_window(rows, key, key_hash)
+        probes = len(match)
+        position = None
+        for i, status in enumerate(rows["prefix"].tolist()):
+            if status == ident and match[i]:
+                probes, position = i + 1, (bucket + i) % self._get_capacity(p)
+                break
+            if status != ident and status != -ident:
+                probes = i + 1
+                break
+
+        stats = self._stats
+        stats["levels_visited"] += 1
+        stats["probes"] += probes
+        self._probe_lengths.add(probes)
+        if position is None:
+            raise KeyError
+        return p, position
 
     # -------------------------------------------------------------------------
     # create, read, update, delete
     # -------------------------------------------------------------------------
 
     def _create_new_hashtable(self):
-        self.p_last += 1
-        capacity = self._get_capacity(self.p_last)
-        table_id = self.dataset.new_block(capacity)
-        index = self.p_last - self.p_init
+        self._create_hashtable(self.p_last + 1)
+
+    def _add_table(self):
+        # table for keys whose probe window is full in every table: a larger
+        # one once the newest is loaded enough, else the largest smaller one
+        # that was dropped, like the table taking the keys left over by
+        # compaction; returns its level
+        p = self._get_free_level()
+        if p is None or \
+                self._get_load(self.p_last) >= GROWTH_LOAD_FACTOR:
+            self._create_new_hashtable()
+            return self.p_last
+        self._create_hashtable(p)
+        return p
+
+    def _get_free_level(self):
+        for p in range(self.p_last - 1, self.p_init - 1, -1):
+            if self.tables_id[p - self.p_init] == 0:
+                return p
+        return None
+
+    def _get_load(self, p):
+        # share of the slots of the pth table holding a key
+        ident = self.dataset._identifier
+        table_id = self.tables_id[p - self.p_init]
+        capacity = self._get_capacity(p)
+        n_keys = 0
+        for start in range(0, capacity, 2**16):
+            rows = np.frombuffer(self.dataset.get_slice_as_bytes(
+                table_id, slice(start, min(start + 2**16, capacity))),
+                dtype=self._row_dtype)
+            n_keys += int(np.count_nonzero(rows["prefix"] == ident))
+        return n_keys / capacity
+
+    def _create_hashtable(self, p):
+        capacity = self._get_capacity(p)
+        table_id, filter_id = self._free_tables.pop(p, (0, 0))
+        if table_id:
+            self.dataset.set_slice_as_bytes(
+                table_id, 0, bytes(capacity * self._row_dtype.itemsize))
+        else:
+            table_id = self.dataset.new_block(capacity)
+        index = p - self.p_init
         self.tables_id[index] = table_id
         self._save_tables_id(index, table_id)
 
         # create a new bloom filters
         if self.n_bloom_filters > 0:
-            filter_id = self._bloom.new_block(
-                capacity * self.n_bloom_filters)
+            n_blocks, k = _get_bloom_size(capacity, self.bloom_fpr)
+            if filter_id:
+                self._bloom.set_values(
+                    filter_id, 0, np.zeros(n_blocks * BLOCK_BYTES, np.uint8))
+            else:
+                filter_id = self._new_bloom_filter(p)
             self._tables_pos.set_value(self._bloom_id, index, filter_id)
             self.bloom_filters[index] = filter_id
+            self._filters[p] = BlockedBloomFilter(
+                np.zeros(n_blocks * BLOCK_BYTES, dtype=np.uint8), k)
 
-    def _insert_in_bloom(self, p, key):
-        key_hash = self._hash(key, self.bloom_seed)
+        # the table is only visible to concurrent readers once it exists
+        self._begin_change()
+        try:
+            self._levels = sorted(self._levels + [p], reverse=True)
+            self.p_last = max(self.p_last, p)
+        finally:
+            self._end_change()
+        # the tables left with keys that fit nowhere else are migrated again,
+        # from the start; cached positions in the dropped table of that size
+        # or behind the migration position are outdated
+        outdated = p < self.p_last or self._kept_levels
+        if self._kept_levels:
+            self._kept_levels = frozenset()
+            self._migration_position = 0
+            self._migration_restart = False
+        if outdated and self.cache_len > 0:
+            self.cache.clear()
+
+    def _new_bloom_filter(self, p):
+        # address of a new filter for the pth table
+        n_blocks, _ = _get_bloom_size(self._get_capacity(p), self.bloom_fpr)
+        return self._bloom.new_block(n_blocks * BLOCK_BYTES)
+
+    def _write_bloom_blocks(self, p, blocks):
+        # the modified blocks of a filter are written with the rows
+        bloom_filter = self._filters[p]
         bloom_p = self.bloom_filters[p - self.p_init]
-        bloom_capacity = self._get_capacity(p) * self.n_bloom_filters
-        bucket = key_hash % bloom_capacity
+        for start, stop in _get_runs(blocks, BLOOM_BLOCK_GAP):
+            self._bloom.set_values(bloom_p, start * BLOCK_BYTES,
+                                   bloom_filter.get_bytes(start, stop))
+
+    def _insert_in_bloom(self, p, bloom_hash):
+        bloom_filter = self._filters[p]
+        block = bloom_filter.add(bloom_hash)
+        self._bloom.set_values(
+            self.bloom_filters[p - self.p_init], block * BLOCK_BYTES,
+            bloom_filter.get_bytes(block, block + 1))
 
-        bloom_value = self._bloom.get_value(bloom_p, bucket)
-        self._bloom.set_value(bloom_p, bucket, bloom_value + 1)
+    def _insert_in_bloom_many(self, p, bloom_hashes):
+        blocks = self._filters[p].add_many(bloom_hashes)
+        self._write_bloom_blocks(p, blocks)
 
     def insert(self, data):
         key = data[self.key]
-        key_hash = self._hash(key)
+        key_hash, bloom_hash = self._hash_key(key)
+        if self.fingerprint is not None:
+            data[self.fingerprint] = key_hash
+        self._stats["inserts"] += 1
 
-        p, position, _ = self._find_insert_or_lookup_position(
-            key, key_hash)
-        table_id = self.tables_id[p - self.p_init]
+        # the row and its bloom counter are committed together
+        self._db.begin_transaction()
+        try:
+            p, position, _ = self._find_insert_or_lookup_position(
+                key, key_hash, bloom_hash)
+            table_id = self.tables_id[p - self.p_init]
 
-        self.dataset.set(table_id, position, data)
-        if self.n_bloom_filters > 0:
-            self._insert_in_bloom(p, key)
+            self.dataset.set(table_id, position, data)
+            if self.n_bloom_filters > 0:
+                self._insert_in_bloom(p, bloom_hash)
+        finally:
+            self._db.end_transaction()
         if self.cache_len > 0:
             self.cache[key] = p, position
+        if self.migrate_buckets > 0:
+            self.migrate(self.migrate_buckets)
+
+    def insert_many(self, keys, data):
+        """
+        (sequence) keys: keys of the rows, the last one wins on duplicates
+        (dict) data: field names mapped to sequences of values, one per key
+        """
+        keys = np.asarray(keys, dtype=self.dataset._field[self.key][3])
+        if keys.ndim != 1 or len(keys) == 0:
+            return
+
+        # keep the last occurrence of duplicated keys
+        _, last = np.unique(keys[::-1], return_index=True)
+        if len(last) < len(keys):
+            keep = np.sort(len(keys) - 1 - last)
+            keys = keys[keep]
+            data = {
+                field: (values[keep] if isinstance(values, np.ndarray)
+                        else [values[i] for i in keep])
+                for field, values in data.items()}
+
+        self._stats["inserts"] += len(keys)
+        self._db.begin_transaction()
+        try:
+            key_hashes, bloom_hashes = self._hash_many(keys)
+            tables = {}
+            found_p, found_pos = self._find_lookup_positions_many(
+                keys, key_hashes, bloom_hashes, tables)
+            rows_new = self.dataset._to_numpy_many(data, len(keys))
+            rows_new[self.key] = keys
+            if self.fingerprint is not None:
+                rows_new[self.fingerprint] = key_hashes
+
+            # overwrite keys already present in place
+            for p in np.unique(found_p[found_p >= 0]):
+                selected = np.flatnonzero(found_p == p)
+                positions, rows, dirty = tables[p]
+                idx = np.searchsorted(positions, found_pos[selected])
+                rows[idx] = rows_new[selected]
+                dirty[idx] = True
+
+            new = np.flatnonzero(found_p < 0)
+            self._place_rows(key_hashes[new], bloom_hashes, new,
+                             rows_new[new], tables)
+        finally:
+            self._db.end_transaction()
+        if self.migrate_buckets > 0:
+            self.migrate(self.migrate_buckets * len(keys))
+
+    def _place_rows(self, key_hashes, bloom_hashes, selected, rows_new,
+                    tables, migrated=None):
+        # place new keys from the last table down to the first one, and in a
+        # new table for those that did not fit, or, for keys moved out of the
+        # migrated table, only in the newer ones, those that do not fit being
+        # left with -1 as level; then write the rows loaded in tables and the
+        # bloom filters, bloom_hashes being those of all keys and selected
+        # the indices of the new ones
+        placed_p = np.full(len(rows_new), -1)
+        placed_pos = np.zeros(len(rows_new), dtype=np.int64)
+        pending = np.arange(len(rows_new))
+        while True:
+            levels = self._levels
+            if migrated is not None:
+                levels = [p for p in levels if p > migrated]
+            for p in levels:
+                if len(pending) == 0:
+                    break
+                pending = self._place_many_in_table(
+                    p, pending, key_hashes, rows_new, tables, placed_p,
+                    placed_pos)
+            if len(pending) == 0 or migrated is not None:
+                break
+            self._add_table()
+        p = self._get_migrated_level()
+        if p is not None:
+            self._placed_in_migrated_level(p, placed_pos[placed_p == p])
+
+        self._write_rows(tables)
+        if self.n_bloom_filters > 0:
+            for p in np.unique(placed_p[placed_p >= 0]):
+                self._insert_in_bloom_many(
+                    p, bloom_hashes[selected[placed_p == p]])
+        return placed_p
 
     def lookup(self, key):
-        key_hash = self._hash(key)
-        p, position = self.find_lookup_position(key, key_hash)
+        if self._db._generation_map is not None:
+            return self._db._read_consistent(self._lookup, key)
+        if self._db._threadsafe:
+            return self._read_stable(self._lookup, key)
+        return self._lookup(key)
+
+    def _lookup(self, key):
+        key_hash, bloom_hash = self._hash_key(key)
+        self._stats["lookups"] += 1
+        try:
+            p, position = self.find_lookup_position(
+                key, key_hash, bloom_hash)
+        except KeyError:
+            self._stats["lookup_misses"] += 1
+            raise
         table_id = self.tables_id[p - self.p_init]
         return self.get(table_id, position)
 
+    def _lookup_rows_many(self, keys):
+        # rows of all keys in input order, and a mask of the keys found
+        keys = np.asarray(keys, dtype=self.dataset._field[self.key][3])
+        rows = np.zeros(len(keys), dtype=self._row_dtype)
+        if len(keys) == 0:
+            return np.zeros(0, dtype=bool), rows
+
+        key_hashes, bloom_hashes = self._hash_many(keys)
+        tables = {}
+        found_p, found_pos = self._find_lookup_positions_many(
+            keys, key_hashes, bloom_hashes, tables)
+        for p in np.unique(found_p[found_p >= 0]):
+            selected = np.flatnonzero(found_p == p)
+            positions, table_rows, _ = tables[p]
+            rows[selected] = table_rows[
+                np.searchsorted(positions, found_pos[selected])]
+        return found_p >= 0, rows
+
+    def lookup_many(self, keys, default=None, field=None):
+        """
+        (sequence) keys: keys to look up
+        (any) default: returned in place of the rows of missing keys
+        (str) field: return the values of this field instead of whole rows
+        """
+        if self._db._generation_map is not None:
+            return self._db._read_consistent(
+                self._lookup_many, keys, default, field)
+        if self._db._threadsafe:
+            return self._read_stable(self._lookup_many, keys, default, field)
+        return self._lookup_many(keys, default, field)
+
+    def _begin_change(self):
+        # changes nest, a table being added while keys are moved
+        if self._change_depth == 0:
+            self._version += 1
+        self._change_depth += 1
+
+    def _end_change(self):
+        self._change_depth -= 1
+        if self._change_depth == 0:
+            self._version += 1
+
+    def _read_stable(self, fn, *args):
+        # without a lock, the lookups of a thread may see a key in neither
+        # table while another thread moves it, or a level whose table was
+        # just dropped, they are retried as reads of a shared file are
+        while True:
+            version = self._version
+            if version % 2 == 0:
+                try:
+                    res, error = fn(*args), None
+                except Exception as e:
+                    res, error = None, e
+                if self._version == version:
+                    if error is not None:
+                        raise error
+                    return res
+            time.sleep(0)
+
+    def _lookup_many(self, keys, default, field):
+        found, rows = self._lookup_rows_many(keys)
+        self._stats["lookups"] += len(found)
+        self._stats["lookup_misses"] += len(found) - int(found.sum())
+        if field is None:
+            values = self.dataset._parse_many(rows[found])
+        else:
+            values = self.dataset._parse_values_many(rows[found], field)
+
+        res = [default] * len(found)
+        for i, value in zip(np.flatnonzero(found).tolist(), values):
+            res[i] = value
+        return res
+
     def delete(self, key):
-        key_hash = self._hash(key)
-        p, position = self.find_lookup_position(key, key_hash)
-        table_id = self.tables_id[p - self.p_init]
-        self.dataset.delete(table_id, position)
+        key_hash, bloom_hash = self._hash_key(key)
+        self._db.begin_transaction()
+        try:
+            p, position = self.find_lookup_position(
+                key, key_hash, bloom_hash)
+            table_id = self.tables_id[p - self.p_init]
+            self.dataset.delete(table_id, position)
+        finally:
+            self._db.end_transaction()
         # remove from cache
         if self.cache_len > 0:
             if key in self.cache:
                 del self.cache[key]
 
+    # -------------------------------------------------------------------------
+    # migration
+    # -------------------------------------------------------------------------
+
+    def migrate(self, n_buckets=None):
+        """
+        (int) n_buckets: number of slots of the oldest tables to go through,
+                         None to go on until only the newest table remains
+                         besides those holding only keys that fit in no
+                         newer table
+
+        Moves the keys of the oldest table to newer ones and drops it once
+        it is empty, returns the number of keys moved. Keys whose probe
+        window is full in every newer table stay where they are, the next
+        table being migrated instead until a table is added.
+        """
+        # the writer lock keeps other threads from moving the same slots
+        lock = self._db._lock
+        if lock is not None:
+            lock.acquire()
+        try:
+            return self._migrate(n_buckets)
+        finally:
+            if lock is not None:
+                lock.release()
+
+    def _migrate(self, n_buckets):
+        n_moved = 0
+        while n_buckets is None or n_buckets > 0:
+            p = self._get_migration_level()
+            if p is None:
+                break
+            capacity = self._get_capacity(p)
+            start = self._migration_position
+            stop = capacity
+            if n_buckets is not None:
+                stop = min(start + n_buckets, capacity)
+                n_buckets -= stop - start
+            for chunk in range(start, stop, MIGRATION_CHUNK_ROWS):
+                chunk_stop = min(chunk + MIGRATION_CHUNK_ROWS, stop)
+                n_moved += self._migrate_rows(p, chunk, chunk_stop)
+                self._migration_position = chunk_stop
+            if stop < capacity:
+                continue
+            if not self._migration_restart:
+                self._drop_level(p)
+                continue
+            # another pass, or the next table when keys that fit nowhere
+            # else were left; the positions cached behind the migration
+            # position would no longer be told apart
+            self._migration_position = 0
+            self._migration_restart = False
+            if self.cache_len > 0:
+                self.cache.clear()
+            if self._migration_left:
+                self._migration_left = False
+                self._kept_levels = self._kept_levels | {p}
+        return n_moved
+
+    def _migrate_rows(self, p, start, stop):
+        # moves the keys held in the start:stop slots of the pth table
+        ident = self.dataset._identifier
+        table_id = self.tables_id[p - self.p_init]
+        rows = np.frombuffer(self.dataset.get_slice_as_bytes(
+            table_id, slice(start, stop)), dtype=self._row_dtype).copy()
+        live = np.flatnonzero(rows["prefix"] == ident)
+        if len(live) == 0:
+            return 0
+
+        key_hashes, bloom_hashes = self._hash_rows(rows[live])
+        self._db.begin_transaction()
+        self._begin_change()
+        try:
+            placed_p = self._place_rows(
+                key_hashes, bloom_hashes, np.arange(len(live)), rows[live],
+                {}, migrated=p)
+            moved = live[placed_p >= 0]
+            rows["prefix"][moved] = -ident
+            self.dataset.set_slice_as_bytes(table_id, start, rows.tobytes())
+        finally:
+            self._end_change()
+            self._db.end_transaction()
+        if len(moved) < len(live):
+            self._migration_restart = True
+            self._migration_left = True
+        self._stats["migrated_keys"] += len(moved)
+        return len(moved)
+
+    def _drop_level(self, p):
+        # the table is no longer visited, its space in the file is taken by
+        # the next table of its size, or reclaimed by DB.compact
+        index = p - self.p_init
+        bloom_id = 0
+        if self.n_bloom_filters > 0:
+            bloom_id = self.bloom_filters[index]
+        self._free_tables[p] = (self.tables_id[index], bloom_id)
+        self._db.begin_transaction()
+        self._begin_change()
+        try:
+            self._levels = [level for level in self._levels if level != p]
+            if self.n_bloom_filters > 0:
+                self._filters = {
+                    level: bloom_filter
+                    for level, bloom_filter in self._filters.items()
+                    if level != p}
+            self.tables_id[index] = 0
+            self._save_tables_id(index, 0)
+            if self.n_bloom_filters > 0:
+                self.bloom_filters[index] = 0
+                self._tables_pos.set_value(self._bloom_id, index, 0)
+        finally:
+            self._end_change()
+            self._db.end_transaction()
+        self._migration_position = 0
+        self._migration_restart = False
+        self._migration_left = False
+
+    # -------------------------------------------------------------------------
+    # compaction
+    # -------------------------------------------------------------------------
+
+    def _copy_from(self, other):
+        # live keys of other, the same hashmap in another file, are placed
+        # in a single table large enough to hold them all, the few that do
+        # not fit in their probe window go to the first, smaller table;
+        # the rows are read once, the table being sized on their number
+        chunks = list(other.scan())
+        n_keys = sum(len(rows) for rows in chunks)
+        p = self.p_init
+        while self._get_capacity(p) * COMPACT_LOAD_FACTOR < n_keys:
+            p += 1
+        if p > self.p_last:
+            self._create_hashtable(p)
+
+        # the first table is not being migrated yet, so that it takes the
+        # keys left over instead of a new, larger table
+        levels = set()
+        migrate_buckets, self.migrate_buckets = self.migrate_buckets, 0
+        try:
+            for rows in chunks:
+                rows = self.dataset._copy_rows(rows, other._db)
+                key_hashes, bloom_hashes = self._hash_rows(rows)
+                levels.update(self._place_rows(
+                    key_hashes, bloom_hashes, np.arange(len(rows)), rows,
+                    {}).tolist())
+        finally:
+            self.migrate_buckets = migrate_buckets
+        if p > self.p_init and self.p_init not in levels:
+            self._drop_level(self.p_init)
+
+    # -------------------------------------------------------------------------
+    # iteration
+    # -------------------------------------------------------------------------
+
+    def scan(self, chunk_rows=2**16, batch=True):
+        """
+        (int) chunk_rows: number of slots read at once from a table
+        (bool) batch: yield structured arrays of live rows, blob fields
+                      holding their addresses, instead of parsed rows
+        """
+        self._db.refresh()
+        for table_id, start, stop in self._get_scan_tasks(chunk_rows):
+            rows, valid = self.dataset.get_slice(
+                table_id, slice(start, stop), raw=True)
+            if not valid.any():
+                continue
+            rows = rows[valid]
+            if batch:
+                yield rows
+            else:
+                yield from self.dataset._parse_many(rows)
+
+    def _get_scan_tasks(self, chunk_rows):
+        # slot ranges of chunk_rows rows covering every table
+        tasks = []
+        for p in reversed(self._levels):
+            table_id = int(self.tables_id[p - self.p_init])
+            capacity = self._get_capacity(p)
+            for start in range(0, capacity, chunk_rows):
+                tasks.append(
+                    (table_id, start, min(start + chunk_rows, capacity)))
+        return tasks
+
+    def parallel_scan(self, fn, workers=None, chunk_rows=2**16,
+                      reducer=None, batch=True):
+        """
+        (function) fn: picklable function called in a worker process on the
+                       live rows of each chunk, as in scan
+        (int) workers: number of worker processes, os.cpu_count() if None
+        (int) chunk_rows: number of table slots handled per task
+        (function) reducer: combines two results of fn, the list of results
+                            in table order is returned when not given
+        (bool) batch: pass structured arrays to fn instead of parsed rows
+
+        Workers open the file read-only, pending writes are flushed first.
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        from functools import partial, reduce
+
+        db = self._db
+        db.flush()
+        kwargs = {"blob_protocol": db.blob_protocol,
+                  "blob_compression": db.blob_compression,
+                  "io": db.io}
+        with ProcessPoolExecutor(
+                max_workers=workers, initializer=_open_scan_db,
+                initargs=(db.filename, kwargs)) as executor:
+            results = list(executor.map(
+                partial(_scan_range, fn, self.dataset.name, batch),
+                self._get_scan_tasks(chunk_rows)))
+
+        if reducer is None:
+            return results
+        return reduce(reducer, results)
+
     # -------------------------------------------------------------------------
     # overload
     # -------------------------------------------------------------------------
 
     def __iter__(self):
-        for p in range(self.p_last - self.p_init + 1):
-            table_id = self.tables_id[p]
-            capacity = self._get_capacity(p + self.p_init)
-            for i in range(capacity):
-                if self.exists(table_id, i):
-                    yield self.get(table_id, i)
+        return self.scan(batch=False)
 
 
 class CompactHashmap(BaseHashmap):
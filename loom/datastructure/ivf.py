@@ -0,0 +1,256 @@
+import numpy as np
+from numpy import dtype
+
+from ..search import (_check_metric, _merge, _score, _search_spans,
+                      _to_queries)
+from .array import COPY_CHUNK_ROWS
+from .base import DataStructure
+
+# rows sampled to train the centroids, per list
+TRAIN_ROWS_PER_LIST = 64
+# scores computed at once when assigning rows to their list
+ASSIGN_CHUNK_SCORES = 2**24
+
+
+def _assign(vectors, centroids, metric):
+    # best centroid of each vector
+    chunk_rows = max(1, ASSIGN_CHUNK_SCORES // len(centroids))
+    res = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), chunk_rows):
+        stop = start + chunk_rows
+        res[start:stop] = _score(
+            centroids, vectors[start:stop], metric).argmax(axis=1)
+    return res
+
+
+def _kmeans(vectors, n_lists, n_iter, rng):
+    # Lloyd iterations starting from random vectors, empty lists being
+    # given a random vector again
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)]
+    for _ in range(n_iter):
+        assigned = _assign(vectors, centroids, "l2")
+        order = np.argsort(assigned, kind="stable")
+        counts = np.bincount(assigned, minlength=n_lists)
+        starts = np.cumsum(counts) - counts
+        filled = counts > 0
+        sums = np.add.reduceat(vectors[order], starts[filled], axis=0)
+        centroids[filled] = sums / counts[filled, None]
+        empty = np.flatnonzero(~filled)
+        centroids[empty] = vectors[rng.choice(len(vectors), len(empty))]
+    return centroids
+
+
+class IVF(DataStructure):
+    def __init__(self, source, field, n_lists=256, metric="l2"):
+        """
+        (List) source: list whose rows are indexed, ids being positions
+        (str) field: field of the vectors, as '(100,)float32'
+        (int) n_lists: number of k-means centroids, each one having the
+                       posting list of the rows closest to it
+        (str) metric: 'dot' or 'l2', used to assign rows and rank results
+
+        The index covers the rows of the source when it was last built,
+        rows appended since are searched exhaustively, rows overwritten
+        since are found under their former vector until it is built again.
+        """
+        _check_metric(metric)
+        self.source = source
+        self.field = field
+        self.n_lists = n_lists
+        self.metric = metric
+        self.dim = source.dataset._field[field][3].shape[0]
+
+        self.dstruct_name = f"{source.dataset.name}_{field}_ivf"
+        self._centroids_name = f"{self.dstruct_name}_centroids"
+        self._postings_name = f"{self.dstruct_name}_postings"
+        self._centroids_addr_name = f"{self.dstruct_name}_centroids_addr"
+        self._postings_addr_name = f"{self.dstruct_name}_postings_addr"
+        self._n_indexed_name = f"{self.dstruct_name}_n_indexed"
+
+    # -------------------------------------------------------------------------
+    # initialization
+    # -------------------------------------------------------------------------
+
+    def _get_header_fields(self):
+        return {
+            self._centroids_addr_name: "uint64",
+            self._postings_addr_name: "uint64",
+            self._n_indexed_name: "uint64",
+        }
+
+    def _compile(self, db):
+        for name, dt in self._get_header_fields().items():
+            db._header_fields[name] = dtype(dt)
+        # postings of a list are contiguous rows, from start to start + count
+        db.create_dataset(
+            self._centroids_name, centroid=f"({self.dim},)float32",
+            start="uint64", count="uint64")
+        db.create_dataset(
+            self._postings_name, row="uint64",
+            vector=f"({self.dim},)float32")
+
+    def _get_dataset_names(self):
+        return [self._centroids_name, self._postings_name]
+
+    def _load(self):
+        self._centroids = self._db[self._centroids_name]
+        self._postings = self._db[self._postings_name]
+        self._load_centroids()
+
+    def _load_centroids(self):
+        self._centroids_addr = int(
+            self._db._get_header(self._centroids_addr_name))
+        self._postings_addr = int(
+            self._db._get_header(self._postings_addr_name))
+        self._n_indexed = int(self._db._get_header(self._n_indexed_name))
+        if self._centroids_addr == 0:
+            self._centroid_vectors = None
+            return
+        rows, valid = self._centroids.get_slice(
+            self._centroids_addr, slice(0, self.n_lists), raw=True)
+        rows = rows[valid]
+        self._centroid_vectors = np.array(rows["centroid"])
+        self._starts = rows["start"].astype(np.int64)
+        self._counts = rows["count"].astype(np.int64)
+
+    def _refresh(self):
+        # index built again by the writer process
+        self._load_centroids()
+
+    # -------------------------------------------------------------------------
+    # build functions
+    # -------------------------------------------------------------------------
+
+    def build(self, n_iter=10, seed=0, chunk_rows=COPY_CHUNK_ROWS):
+        """
+        (int) n_iter: number of k-means iterations
+        (int) seed: seed of the rows sampled to train the centroids
+        (int) chunk_rows: rows of the source read at once
+
+        Trains the centroids on a sample of the source, then writes the rows
+        of each list contiguously. The previous index is used by searches
+        until the new one is complete, its space being reclaimed by
+        DB.compact.
+        """
+        n = len(self.source)
+        if n == 0:
+            return
+        rng = np.random.default_rng(seed)
+        n_lists = min(self.n_lists, n)
+        sample = np.sort(rng.choice(
+            n, min(n, n_lists * TRAIN_ROWS_PER_LIST), replace=False))
+        centroids = _kmeans(self._get_vectors(sample), n_lists, n_iter, rng)
+
+        assigned = np.empty(n, dtype=np.int64)
+        for start in range(0, n, chunk_rows):
+            stop = min(start + chunk_rows, n)
+            assigned[start:stop] = _assign(
+                self.source.get_slice(start, stop)[self.field].reshape(
+                    stop - start, -1), centroids, self.metric)
+        order = np.argsort(assigned, kind="stable")
+        counts = np.bincount(assigned, minlength=n_lists)
+
+        self._db.begin_transaction()
+        try:
+            postings_addr = self._postings.new_block(n)
+        finally:
+            self._db.end_transaction()
+        for start in range(0, n, chunk_rows):
+            positions = order[start:start + chunk_rows]
+            rows = self._postings._to_numpy_many(
+                {"row": positions, "vector": self._get_vectors(positions)},
+                len(positions))
+            self._db.begin_transaction()
+            try:
+                self._postings.set_slice_as_bytes(
+                    postings_addr, start, rows.tobytes())
+            finally:
+                self._db.end_transaction()
+
+        # the new index is switched to in one transaction
+        rows = self._centroids._to_numpy_many(
+            {"centroid": centroids, "start": np.cumsum(counts) - counts,
+             "count": counts}, n_lists)
+        self._db.begin_transaction()
+        try:
+            centroids_addr = self._centroids.new_block(self.n_lists)
+            self._centroids.set_slice_as_bytes(
+                centroids_addr, 0, rows.tobytes())
+            self._db._set_header(self._centroids_addr_name, centroids_addr)
+            self._db._set_header(self._postings_addr_name, postings_addr)
+            self._db._set_header(self._n_indexed_name, n)
+        finally:
+            self._db.end_transaction()
+        self._load_centroids()
+
+    def _get_vectors(self, positions):
+        rows = self.source.lookup_many(positions)
+        return rows[self.field].reshape(len(positions), -1)
+
+    def _copy_from(self, other):
+        # centroids and postings of other, the same index in another file
+        if other._centroids_addr == 0:
+            return
+        centroids_addr = self._centroids.new_block(self.n_lists)
+        self._centroids.set_slice_as_bytes(
+            centroids_addr, 0, other._centroids.get_slice_as_bytes(
+                other._centroids_addr, slice(0, self.n_lists)))
+        n = other._n_indexed
+        postings_addr = self._postings.new_block(n)
+        for start in range(0, n, COPY_CHUNK_ROWS):
+            stop = min(start + COPY_CHUNK_ROWS, n)
+            self._postings.set_slice_as_bytes(
+                postings_addr, start, other._postings.get_slice_as_bytes(
+                    other._postings_addr, slice(start, stop)))
+        self._db._set_header(self._centroids_addr_name, centroids_addr)
+        self._db._set_header(self._postings_addr_name, postings_addr)
+        self._db._set_header(self._n_indexed_name, n)
+        self._load_centroids()
+
+    # -------------------------------------------------------------------------
+    # search functions
+    # -------------------------------------------------------------------------
+
+    def search(self, query, k=10, n_probe=8, chunk_rows=COPY_CHUNK_ROWS,
+               workers=None):
+        """
+        (ndarray) query: (dim,) vector or (n_queries, dim) array
+        (int) k: number of results per query
+        (int) n_probe: number of lists searched per query
+        (int) chunk_rows: rows read at once
+        (int) workers: threads scoring the rows, os.cpu_count() if None
+
+        Returns the scores and positions of the best rows as DB.search.
+        """
+        if self._db._generation_map is not None:
+            return self._db._read_consistent(
+                self._search, query, k, n_probe, chunk_rows, workers)
+        return self._search(query, k, n_probe, chunk_rows, workers)
+
+    def _search(self, query, k, n_probe, chunk_rows, workers):
+        queries, single = _to_queries(query, self.dim)
+        spans = []
+        if self._centroid_vectors is not None:
+            n_probe = min(n_probe, len(self._centroid_vectors))
+            scores = _score(self._centroid_vectors, queries, self.metric)
+            probes = np.argpartition(-scores, n_probe - 1, axis=1)
+            probes = probes[:, :n_probe]
+            # each list is read once for all the queries probing it
+            for list_id in np.unique(probes).tolist():
+                selected = np.flatnonzero((probes == list_id).any(axis=1))
+                start = self._starts[list_id]
+                stop = start + self._counts[list_id]
+                for a in range(start, stop, chunk_rows):
+                    spans.append((self._postings_addr, a,
+                                  min(a + chunk_rows, stop), 0, selected))
+        results = _search_spans(
+            self._postings, "vector", spans, queries, self.metric, k,
+            workers, id_field="row")
+
+        # rows appended since the index was built
+        spans = ((*chunk, None) for chunk in self.source._get_chunks(
+            self._n_indexed, len(self.source), chunk_rows))
+        results += _search_spans(
+            self.source.dataset, self.field, spans, queries, self.metric, k,
+            workers)
+        return _merge(results, len(queries), k, self.metric, single)
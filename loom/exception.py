@@ -8,3 +8,7 @@ class DatasetExistsError(Exception):
 
 class NotCompiledError(Exception):
     pass
+
+
+class DatabaseLockedError(Exception):
+    pass
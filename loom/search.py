@@ -0,0 +1,120 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+METRICS = ("dot", "l2")
+
+
+def _to_queries(query, dim):
+    queries = np.asarray(query, dtype=np.float32)
+    single = queries.ndim == 1
+    queries = np.atleast_2d(queries)
+    if queries.ndim != 2 or queries.shape[1] != dim:
+        raise ValueError(
+            f"Expected queries of dimension {dim}, got {queries.shape}")
+    return queries, single
+
+
+def _check_metric(metric):
+    if metric not in METRICS:
+        raise ValueError(f"Metric {metric} unknown, choose among {METRICS}")
+
+
+def _score(vectors, queries, metric):
+    # (n_queries, n_vectors) scores, higher is better: dot products, or
+    # squared L2 distances negated
+    scores = queries @ vectors.T
+    if metric == "l2":
+        scores *= 2
+        scores -= (vectors * vectors).sum(axis=1)[None]
+        scores -= (queries * queries).sum(axis=1)[:, None]
+    return scores
+
+
+def _select(scores, ids, k):
+    # the k best scores of each query, sorted, with their ids
+    if scores.shape[1] > k:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, part, axis=1)
+        ids = np.take_along_axis(ids, part, axis=1)
+    order = np.argsort(-scores, axis=1, kind="stable")
+    return (np.take_along_axis(scores, order, axis=1),
+            np.take_along_axis(ids, order, axis=1))
+
+
+def _get_block_chunks(blocks, chunk_rows):
+    # (block id, start, stop, first id) slices of the given blocks
+    first_id = 0
+    for block_id, n_rows in blocks:
+        for start in range(0, n_rows, chunk_rows):
+            yield (block_id, start, min(start + chunk_rows, n_rows),
+                   first_id + start)
+        first_id += n_rows
+
+
+def _search_rows(data, dataset, field, id_field, first_id, queries,
+                 selected, metric, k):
+    # best rows of a block slice as read from the file, for the queries
+    # selected or all of them, the other queries getting no candidates
+    rows = np.frombuffer(data, dtype=dataset._get_prefixed_dtype())
+    valid = np.flatnonzero(rows["prefix"] == dataset._identifier)
+    vectors = rows[field][valid].reshape(len(valid), -1)
+    if id_field is None:
+        ids = first_id + valid
+    else:
+        ids = rows[id_field][valid].astype(np.int64)
+
+    if selected is None:
+        scores = _score(vectors, queries, metric)
+        return _select(scores, np.broadcast_to(ids, scores.shape), k)
+    scores = _score(vectors, queries[selected], metric)
+    scores, ids = _select(scores, np.broadcast_to(ids, scores.shape), k)
+    res_scores = np.full((len(queries), scores.shape[1]), -np.inf,
+                         dtype=np.float32)
+    res_ids = np.full(res_scores.shape, -1, dtype=np.int64)
+    res_scores[selected] = scores
+    res_ids[selected] = ids
+    return res_scores, res_ids
+
+
+def _search_spans(dataset, field, spans, queries, metric, k, workers=None,
+                  id_field=None):
+    # spans are (block_id, start, stop, first_id, selected) slices of rows,
+    # ids being first_id plus the row offset unless read from id_field, and
+    # selected the queries scored against them, None for all; slices are
+    # read by the calling thread while the previous ones are scored by the
+    # workers, and each one only keeps its k best rows
+    workers = workers or os.cpu_count()
+    results = []
+    with ThreadPoolExecutor(workers) as executor:
+        pending = deque()
+        for block_id, start, stop, first_id, selected in spans:
+            data = dataset.get_slice_as_bytes(block_id, slice(start, stop))
+            pending.append(executor.submit(
+                _search_rows, data, dataset, field, id_field, first_id,
+                queries, selected, metric, k))
+            # bound the slices held in memory
+            while len(pending) > 2 * workers:
+                results.append(pending.popleft().result())
+        results.extend(future.result() for future in pending)
+    return results
+
+
+def _merge(results, n_queries, k, metric, single):
+    # best of the candidates of every slice, queries with fewer than k
+    # candidates are completed with -1 ids and the worst score, -inf for
+    # dot and +inf for l2 once negated back
+    scores = np.concatenate(
+        [np.full((n_queries, k), -np.inf, dtype=np.float32)] +
+        [scores for scores, _ in results], axis=1)
+    ids = np.concatenate(
+        [np.full((n_queries, k), -1, dtype=np.int64)] +
+        [ids for _, ids in results], axis=1)
+    scores, ids = _select(scores, ids, k)
+    if metric == "l2":
+        scores = -scores
+    if single:
+        return scores[0], ids[0]
+    return scores, ids
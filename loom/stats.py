@@ -0,0 +1,97 @@
+import numpy as np
+
+# stats that go up and down, the others only ever increase
+GAUGES = frozenset((
+    "hit_rate", "size", "pages", "dirty_pages", "capacity_pages", "levels",
+    "cache_hit_rate", "cache_size"))
+
+
+class Histogram:
+    def __init__(self, scale=1.):
+        """
+        (float) scale: unit of the observed integers in the reported bounds,
+                       1e-9 for durations observed in nanoseconds
+
+        Bucket b counts the values of b bits, so that adding one is a single
+        list update.
+        """
+        self.scale = scale
+        self.counts = [0] * 65
+        self.sum = 0
+
+    def add(self, value):
+        self.counts[value.bit_length()] += 1
+        self.sum += value
+
+    def add_many(self, values):
+        values = np.asarray(values, dtype=np.int64)
+        bits = np.zeros(len(values), dtype=np.int64)
+        positive = values > 0
+        bits[positive] = np.floor(np.log2(values[positive])) + 1
+        for b, n in zip(*np.unique(bits, return_counts=True)):
+            self.counts[int(b)] += int(n)
+        self.sum += int(values.sum())
+
+    def to_dict(self):
+        # cumulative counts of the values lower or equal to each bound
+        last = max((b for b, n in enumerate(self.counts) if n), default=0)
+        buckets = {}
+        total = 0
+        for b in range(last + 1):
+            total += self.counts[b]
+            buckets[(2**b - 1) * self.scale] = total
+        return {"buckets": buckets, "sum": self.sum * self.scale,
+                "count": total}
+
+
+def _get_lru_stats(lru):
+    hits, misses = lru.get_stats()
+    total = hits + misses
+    return {"hits": hits, "misses": misses,
+            "hit_rate": hits / total if total else 0., "size": len(lru)}
+
+
+def to_prometheus(stats, prefix="loom", labels=None):
+    """
+    (dict) stats: as returned by DB.stats, components mapped to counters
+                  and histograms
+    (str) prefix: prefix of the metric names
+    (dict) labels: labels added to every sample
+
+    Returns the stats in the Prometheus text exposition format, counters
+    being suffixed with _total.
+    """
+    labels = labels or {}
+    lines = []
+    for component, values in stats.items():
+        for name, value in values.items():
+            metric = f"{prefix}_{component}_{name}".replace(".", "_")
+            metric = metric.replace("-", "_")
+            if isinstance(value, dict) and "buckets" in value:
+                lines.append(f"# TYPE {metric} histogram")
+                for bound, count in value["buckets"].items():
+                    lines.append(_format_sample(
+                        f"{metric}_bucket", {**labels, "le": f"{bound:g}"},
+                        count))
+                lines.append(_format_sample(
+                    f"{metric}_bucket", {**labels, "le": "+Inf"},
+                    value["count"]))
+                lines.append(_format_sample(
+                    f"{metric}_sum", labels, value["sum"]))
+                lines.append(_format_sample(
+                    f"{metric}_count", labels, value["count"]))
+            elif isinstance(value, (bool, int, float)):
+                if name in GAUGES or isinstance(value, bool):
+                    lines.append(f"# TYPE {metric} gauge")
+                else:
+                    metric = f"{metric}_total"
+                    lines.append(f"# TYPE {metric} counter")
+                lines.append(_format_sample(metric, labels, +value))
+    return "\n".join(lines) + "\n"
+
+
+def _format_sample(metric, labels, value):
+    if len(labels) == 0:
+        return f"{metric} {value}"
+    text = ",".join(f'{key}="{label}"' for key, label in labels.items())
+    return f"{metric}{{{text}}} {value}"
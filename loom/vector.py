@@ -0,0 +1,209 @@
+import numpy as np
+
+from .database import Dict
+from .datastructure import List
+from .datastructure import hashtable
+
+
+def _map_vectors(mapper, rows):
+    # keys and vectors of a chunk of rows, in a worker process
+    matrix = hashtable._scan_db["matrix"]
+    vectors = matrix.lookup_many(rows["value"].astype(np.int64))["vector"]
+    return mapper(rows["key"].tolist(), vectors)
+
+
+class VectorDict(Dict):
+    def __init__(self, filename, dim=None, flag="w", **kwargs):
+        """
+        (str) filename: string name of the database file
+        (int) dim: number of float32 components of the vectors, read from
+                   the file when it exists
+        (kwargs) kwargs: passed to Dict, whose values are the row ids
+
+        Keys map through the hashmap to the row ids of an append-only
+        matrix of float32 vectors, so that empty hashmap slots only cost a
+        key and a row id, and rows are read in runs from the matrix.
+        Overwritten keys are updated in place, the rows of deleted keys are
+        kept.
+        """
+        self.dim = dim
+        kwargs["dtype"] = "uint64"
+        kwargs["lru_cache"] = 0
+        super().__init__(filename, flag=flag, **kwargs)
+
+    def _create_datastructures(self):
+        if self.dim is None:
+            raise ValueError("dim is required to create a VectorDict")
+        self.vectors = self.db.create_dataset(
+            "vectors", vector=f"({self.dim},)float32")
+        self.matrix = self.db.create_datastructure(
+            "matrix", List(self.vectors, start_size=2**12))
+
+    def _load_datastructures(self):
+        self.vectors = self.db["vectors"]
+        self.matrix = self.db["matrix"]
+        dim = self.vectors._field["vector"][3].shape[0]
+        if self.dim is not None and self.dim != dim:
+            raise ValueError(f"File holds vectors of dim {dim}")
+        self.dim = dim
+
+    def _to_matrix(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim != 2 or vectors.shape[1] != self.dim:
+            raise ValueError(
+                f"Expected vectors of shape (n, {self.dim}), got "
+                f"{vectors.shape}")
+        return vectors
+
+    # -------------------------------------------------------------------------
+    # public functions
+    # -------------------------------------------------------------------------
+
+    def __setitem__(self, key, vector):
+        self.set_many([key], np.asarray(vector, dtype=np.float32)[None])
+
+    def __getitem__(self, key):
+        table_key = self._get_table_key(key)
+        if table_key is None:
+            raise KeyError(key)
+        row = self.table[table_key]["value"]
+        return self.matrix.lookup_many([row])["vector"][0]
+
+    def get_many(self, keys, default=None):
+        """
+        (sequence) keys: keys to look up
+        (object) default: returned for missing keys
+
+        Returns a list of the vectors, as Dict.get_many, see get_vectors for
+        an array.
+        """
+        keys = list(keys)
+        positions = self._get_positions(keys)
+        found = np.flatnonzero(positions >= 0)
+        res = [default] * len(keys)
+        if len(found):
+            vectors = self.matrix.lookup_many(positions[found])["vector"]
+            for i, vector in zip(found.tolist(), vectors):
+                res[i] = vector
+        return res
+
+    def get_vectors(self, keys, default=None):
+        """
+        (sequence) keys: keys to look up
+        (float) default: value of the rows of missing keys, a KeyError is
+                         raised for them when not given
+
+        Returns an (n, dim) float32 array, the vectors being gathered from
+        the matrix with one read per run of nearby rows.
+        """
+        keys = list(keys)
+        positions = self._get_positions(keys)
+        missing = positions < 0
+        if missing.any() and default is None:
+            raise KeyError(keys[int(np.flatnonzero(missing)[0])])
+
+        res = np.empty((len(keys), self.dim), dtype=np.float32)
+        res[missing] = default
+        if not missing.all():
+            res[~missing] = self.matrix.lookup_many(
+                positions[~missing])["vector"]
+        return res
+
+    def _get_positions(self, keys):
+        # row ids of the keys, -1 for missing keys
+        table_keys = [self._get_table_key(key) for key in keys]
+        found = [i for i, key in enumerate(table_keys) if key is not None]
+        rows = self.table.lookup_many(
+            [table_keys[i] for i in found], field="value")
+
+        positions = np.full(len(keys), -1, dtype=np.int64)
+        for i, row in zip(found, rows):
+            if row is not None:
+                positions[i] = row
+        return positions
+
+    def set_many(self, keys, vectors):
+        """
+        (sequence) keys: keys of the vectors, the last one wins on duplicates
+        (array) vectors: (n, dim) array of the vectors
+        """
+        keys = list(keys)
+        vectors = self._to_matrix(vectors)
+        if len(keys) != len(vectors):
+            raise ValueError("keys and vectors differ in length")
+        table_keys = self._get_table_keys(keys)
+
+        # last occurrence of each key
+        last = {}
+        for i, key in enumerate(table_keys):
+            last[key] = i
+        if len(last) < len(table_keys):
+            table_keys = list(last)
+            vectors = vectors[list(last.values())]
+
+        self.db.begin_transaction()
+        try:
+            rows = self.table.lookup_many(table_keys, field="value")
+            new = [i for i, row in enumerate(rows) if row is None]
+            old = [i for i, row in enumerate(rows) if row is not None]
+            # overwritten keys are updated in place, in runs of rows
+            if len(old):
+                self.matrix.insert_many(
+                    [int(rows[i]) for i in old],
+                    self.vectors._to_numpy_many(
+                        {"vector": vectors[old]}, len(old)))
+            if len(new) == 0:
+                return
+
+            start = len(self.matrix)
+            self.matrix._extend_rows(self.vectors._to_numpy_many(
+                {"vector": vectors[new]}, len(new)))
+            rows = np.arange(start, start + len(new), dtype=np.uint64)
+            self.table.insert_many(
+                [table_keys[i] for i in new], {"value": rows})
+        finally:
+            self.db.end_transaction()
+
+    def get_slice(self, start, stop):
+        """
+        (int) start, stop: bounds of the rows of the matrix to read
+
+        Returns the (n, dim) float32 rows in row id order, deleted keys
+        included.
+        """
+        return self.matrix.get_slice(start, stop)["vector"]
+
+    def values(self, chunk_rows=2**16):
+        for _, vectors in self._scan_vectors(chunk_rows):
+            yield from vectors
+
+    def items(self, chunk_rows=2**16):
+        """
+        Keys are yielded as stored, that is hashed when use_hash is set,
+        and as strings when verify_keys is set.
+        """
+        for keys, vectors in self._scan_vectors(chunk_rows):
+            yield from zip(keys, vectors)
+
+    def _scan_vectors(self, chunk_rows):
+        for keys, rows in self._scan(chunk_rows):
+            if len(keys) == 0:
+                continue
+            positions = rows["value"].astype(np.int64)
+            yield keys, self.matrix.lookup_many(positions)["vector"]
+
+    def map_reduce(self, mapper, reducer=None, workers=None,
+                   chunk_rows=2**16):
+        """
+        (function) mapper: called in worker processes with the keys of a
+                           chunk of rows, stored as in Dict.map_reduce, and
+                           their (n, dim) vectors
+        (function) reducer: combines two mapper results, the list of mapper
+                            results is returned when not given
+        (int) workers: number of worker processes, os.cpu_count() if None
+        (int) chunk_rows: number of table slots handled per task
+        """
+        from functools import partial
+        return self.table.parallel_scan(
+            partial(_map_vectors, mapper), workers=workers,
+            chunk_rows=chunk_rows, reducer=reducer)
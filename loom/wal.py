@@ -0,0 +1,101 @@
+import os
+import zlib
+
+from numpy import array, frombuffer, uint64
+
+PAGE_SIZE = 4096
+COMMIT_MARKER = 2**64 - 1
+RECORD_HEADER_SIZE = 16
+
+
+class WriteAheadLog:
+    def __init__(self, filename, durability="flush"):
+        """
+        (str) filename: string name of the log file
+        (str) durability: 'none', 'flush' or 'fsync', applied once per group
+        """
+        self.filename = filename
+        self.durability = durability
+        self.f = open(filename, "ab+")
+
+    # -------------------------------------------------------------------------
+    # writing
+    # -------------------------------------------------------------------------
+
+    def write_group(self, records):
+        # records are (index, bytes) pairs followed by a commit marker that
+        # holds the checksum of the group, a group without a valid marker
+        # is ignored on replay
+        chunks = []
+        checksum = 0
+        for index, data in records:
+            head = array([index, len(data)], dtype=uint64).tobytes()
+            checksum = zlib.crc32(data, zlib.crc32(head, checksum))
+            chunks.append(head)
+            chunks.append(data)
+        chunks.append(array([COMMIT_MARKER, checksum], dtype=uint64).tobytes())
+
+        # the log always reaches the OS before the main file is written
+        self.f.write(b"".join(chunks))
+        self.f.flush()
+        if self.durability == "fsync":
+            os.fsync(self.f.fileno())
+
+    def truncate(self):
+        self.f.truncate(0)
+        self.f.flush()
+        if self.durability == "fsync":
+            os.fsync(self.f.fileno())
+
+    # -------------------------------------------------------------------------
+    # reading
+    # -------------------------------------------------------------------------
+
+    def read_groups(self):
+        self.f.seek(0)
+        data = self.f.read()
+
+        position = 0
+        records = []
+        checksum = 0
+        while position + RECORD_HEADER_SIZE <= len(data):
+            index, size = frombuffer(
+                data, dtype=uint64, count=2, offset=position).tolist()
+            if index == COMMIT_MARKER:
+                if size != checksum:
+                    return
+                yield records
+                records = []
+                checksum = 0
+                position += RECORD_HEADER_SIZE
+                continue
+
+            end = position + RECORD_HEADER_SIZE + size
+            if end > len(data):
+                return
+            checksum = zlib.crc32(data[position:end], checksum)
+            records.append(
+                (index, data[position + RECORD_HEADER_SIZE:end]))
+            position = end
+
+    def replay(self, f):
+        """
+        (file) f: main database file, opened for writing
+
+        Applies every committed group to f and empties the log.
+        """
+        n_groups = 0
+        for records in self.read_groups():
+            for index, data in records:
+                f.seek(index)
+                f.write(data)
+            n_groups += 1
+        if n_groups > 0:
+            f.flush()
+            if self.durability == "fsync":
+                os.fsync(f.fileno())
+        self.truncate()
+        return n_groups
+
+    def close(self):
+        self.f.close()
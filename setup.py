@@ -3,6 +3,6 @@ from setuptools import find_packages, setup
 setup(
     name="loom-db",
     version="0.0.0a",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks", "benchmarks.*"]),
     install_requires=["numpy", "lru-dict"]
 )